@@ -23,15 +23,39 @@ Driver for the Love 8C process controller, for communication using the Modbus AS
 
 """
 
+import os
+import sys
+
+import love8c_fast
+
+if __name__ == '__main__':
+	#Emulated answers and cached port listings, before loading the serial stack
+	if love8c_fast.main(sys.argv[1:]):
+		sys.exit()
+
 import minimalmodbus
-import argparse
 
 import json
 
-import sys
-import glob
+import time
+import binascii
+import collections
+import struct
+import threading
 import serial
 
+if sys.version_info[0] > 2:
+	long = int
+
+#Exceptions of minimalmodbus >= 1.0, older versions raise IOError and ValueError
+NoResponseError = getattr(minimalmodbus, 'NoResponseError', IOError)
+InvalidResponseError = getattr(minimalmodbus, 'InvalidResponseError', ValueError)
+SlaveReportedException = getattr(minimalmodbus, 'SlaveReportedException', ValueError)
+
+class DeviceOfflineError(NoResponseError):
+	"""Raised without bus traffic while the circuit breaker of a device is open (see DeviceHealth)."""
+	pass
+
 __author__  = "Mauricio Galetto "
 __license__ = "Apache License, Version 2.0"
 
@@ -350,11 +374,476 @@ REGISTER_DETAILS = {
 }
 
 
+#Seconds a cached value stays fresh (see RegisterCache), None keeps it until invalidated
+CACHE_TTL_DEFAULT = 0.5
+REGISTER_CACHE_TTL = {
+			'software_version': None,
+			'input_temperature_sensor_type': None,
+			'control_method': None,
+			'alarm_1_type': None,
+			'alarm_2_type': None,
+			'upper_limit_of_temperature_range': None,
+			'lower_limit_of_temperature_range': None,
+			'temperature_unit_display_selection': None,
+			'heating_cooling_control_selection': None,
+			'communication_write_in_selection': None
+}
+
+#Registers that read back a different value than the one written (see LOCK_STATUS_SET)
+CACHE_INVALIDATE_ON_WRITE = ['lock_status', 'at_setting']
+
+"""Text of the values of the enumerated registers."""
+REGISTER_ENUMS = {
+			'input_temperature_sensor_type': SENSOR_TYPES,
+			'control_method': CONTROL_MODES,
+			'alarm_1_type': ALARMS_TYPES,
+			'alarm_2_type': ALARMS_TYPES,
+			'status': STATUS,
+			'lock_status': LOCK_STATUS_READ
+}
+
+"""Bits of the leds register, see the reverse engineering notes above."""
+LEDS_BITS = [('AT', 128), ('Output', 64), ('Alarm1', 32), ('Alarm2', 16), ('C', 8), ('F', 4)]
+
+def decode_leds(value):
+	"""Split the leds register into a dict like LEDS, 1 for every lit led."""
+	leds = {}
+	for name, bit in LEDS_BITS:
+		leds[name] = 1 if value & bit else 0
+	return leds
+
+
+class Register(object):
+	"""Compiled description of one register, built from the REGISTER_* dicts by :func:`compile_registers`."""
+	
+	__slots__ = ('name', 'address', 'decimals', 'scale', 'signed', 'functioncode',
+		'writable', 'write_decimals', 'write_signed', 'write_functioncode', 'minimum', 'maximum',
+		'enum', 'label')
+	
+	def __init__(self, name):
+		read = REGISTER_READ_DETAIL[name]
+		self.name = name
+		self.address = REGISTER_START[name]
+		self.decimals = read[0]
+		self.scale = float(10 ** read[0]) if read[0] else 1
+		self.functioncode = read[1]
+		self.signed = read[2] == 1
+		self.writable = name in REGISTER_WRITE_DETAIL
+		write = REGISTER_WRITE_DETAIL.get(name, ["int", 0, 6, 0, None, None])
+		self.write_decimals = write[1]
+		self.write_functioncode = write[2]
+		self.write_signed = write[3] == 1
+		self.minimum = write[4]
+		self.maximum = write[5]
+		self.enum = REGISTER_ENUMS.get(name)
+		self.label = REGISTER_LABELS.get(name, name)
+	
+	def decode(self, raw):
+		"""Scaled value of a raw 16 bit word."""
+		if self.signed and raw >= 0x8000:
+			raw = raw - 0x10000
+		if self.scale != 1:
+			return raw / self.scale
+		return raw
+	
+	def encode(self, value):
+		"""Raw 16 bit word to write *value*, rounded to the write decimals.
+		
+		Every write sends this word, so the cached and read back values match the device.
+		"""
+		raw = int(round(value * 10 ** self.write_decimals))
+		if raw < 0:
+			raw = raw + 0x10000
+		return raw & 0xFFFF
+	
+	def check(self, value):
+		"""True if *value* is in the writable range."""
+		return checkNumerical(value, minvalue=self.minimum, maxvalue=self.maximum)
+	
+	def text(self, value):
+		"""Text of a value of an enumerated register (the leds as a dict), None for the others."""
+		if self.name == 'leds':
+			return decode_leds(value)
+		if self.enum is None:
+			return None
+		return self.enum.get(value)
+
+
+class BlockLayout(object):
+	"""One block read of a plan: start address, register count and where each value sits."""
+	
+	__slots__ = ('start', 'count', 'names', 'fields')
+	
+	def __init__(self, start, count, names):
+		self.start = start
+		self.count = count
+		self.names = names
+		self.fields = [(REGISTERS[x].address - start, x, REGISTERS[x].signed, REGISTERS[x].scale) for x in names]
+	
+	def decode(self, words, values):
+		"""Scale every value of a block of raw words into the *values* dict, in one pass."""
+		for offset, name, signed, scale in self.fields:
+			raw = words[offset]
+			if signed and raw >= 0x8000:
+				raw = raw - 0x10000
+			values[name] = raw / scale if scale != 1 else raw
+		return values
+
+def compile_registers():
+	"""Build the name -> :class:`Register` table from the REGISTER_* dicts."""
+	registers = {}
+	for name in REGISTER_READ_DETAIL:
+		registers[name] = Register(name)
+	return registers
+
+REGISTERS = compile_registers()
+
+_layouts = {}
+
+def block_layouts(names):
+	"""Compiled :func:`plan_reads` of *names* as a list of :class:`BlockLayout`, cached per name list."""
+	key = tuple(names)
+	layouts = _layouts.get(key)
+	if layouts is None:
+		layouts = [BlockLayout(start, count, block_names) for start, count, block_names in plan_reads(names)]
+		if len(_layouts) < 1024:
+			_layouts[key] = layouts
+	return layouts
+
+#Adaptive timeouts: the wait for the answer, on top of the transmission time, is
+#TIMEOUT_FACTOR times the p95 of the last LATENCY_SAMPLES device turnarounds
+TIMEOUT_MIN = 0.05
+TIMEOUT_MAX = 0.5
+TIMEOUT_FACTOR = 2.0
+LATENCY_SAMPLES = 50
+LATENCY_MIN_SAMPLES = 5
+
+#Circuit breaker: unanswered requests in a row to stop talking to a device, and
+#seconds before a probe request is let through (doubled on every failed probe)
+BREAKER_FAILURES = 3
+BREAKER_BACKOFF = 5.0
+BREAKER_BACKOFF_MAX = 300.0
+
+
+class DeviceHealth(object):
+	"""Response times and failures of one slave, shared by every :class:`Love8C` on it.
+	
+	After :data:`BREAKER_FAILURES` unanswered requests in a row the breaker opens and
+	requests fail at once with :class:`DeviceOfflineError`, until the backoff time
+	passes and one probe request is let through (half-open). An answer closes it.
+	"""
+	
+	def __init__(self):
+		self.turnarounds = collections.deque(maxlen=LATENCY_SAMPLES)
+		self.failures = 0
+		self.backoff = 0
+		self.retry_at = 0
+	
+	def is_open(self):
+		return self.failures >= BREAKER_FAILURES
+	
+	def check(self, now):
+		if self.is_open() and now < self.retry_at:
+			raise DeviceOfflineError('The instrument is not answering, next try in {0:.1f} s'.format(self.retry_at - now))
+	
+	def success(self, turnaround):
+		self.turnarounds.append(turnaround)
+		self.failures = 0
+		self.backoff = 0
+	
+	def failure(self, now):
+		self.failures += 1
+		if self.is_open():
+			self.backoff = min(BREAKER_BACKOFF_MAX, self.backoff * 2 or BREAKER_BACKOFF)
+			self.retry_at = now + self.backoff
+	
+	def timeout(self):
+		"""Seconds to wait for the device once the request and answer are on the wire."""
+		if len(self.turnarounds) < LATENCY_MIN_SAMPLES:
+			return TIMEOUT_MAX
+		ordered = sorted(self.turnarounds)
+		p95 = ordered[int(round(0.95 * (len(ordered) - 1)))]
+		return min(TIMEOUT_MAX, max(TIMEOUT_MIN, TIMEOUT_FACTOR * p95))
+
+"""Health of every device, key: (port name, slave address)."""
+_device_health = {}
+
+def device_health(portname, slaveaddress):
+	key = (portname, slaveaddress)
+	if key not in _device_health:
+		_device_health[key] = DeviceHealth()
+	return _device_health[key]
+
+"""Upper bounds (seconds) of the latency histogram buckets, like Prometheus 'le'."""
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+"""Results of a transaction, see :func:`transaction_result`."""
+TRANSACTION_RESULTS = ['ok', 'timeout', 'invalid', 'exception', 'offline', 'port', 'error']
+
+def transaction_result(ex):
+	"""Result name of a transaction that raised *ex* (None for success)."""
+	if ex is None:
+		return 'ok'
+	if isinstance(ex, DeviceOfflineError):
+		return 'offline'
+	if isinstance(ex, serial.SerialException):
+		return 'port'
+	if isinstance(ex, NoResponseError):
+		return 'timeout'
+	if SlaveReportedException is not InvalidResponseError and isinstance(ex, SlaveReportedException):
+		return 'exception'
+	if isinstance(ex, InvalidResponseError):
+		return 'invalid'
+	if isinstance(ex, (IOError, OSError)):
+		return 'port'
+	return 'error'
+
+def response_exception_code(answer, mode):
+	"""Modbus exception code of a raw answer frame, None when it is not an exception answer."""
+	try:
+		if mode == minimalmodbus.MODE_ASCII:
+			functioncode = int(answer[3:5], 16)
+			code = int(answer[5:7], 16)
+		else:
+			#minimalmodbus gives the RTU answer as a latin-1 str
+			if not isinstance(answer, (bytes, bytearray)):
+				answer = bytearray(answer, 'latin1')
+			functioncode = bytearray(answer)[1]
+			code = bytearray(answer)[2]
+	except (IndexError, ValueError, TypeError):
+		return None
+	if functioncode & 0x80:
+		return code
+	return None
+
+
+class TransactionStats(object):
+	"""Counters and latency histogram of the transactions of one slave.
+	
+	A transaction is one :meth:`Love8C.get_register`, :meth:`Love8C.get_registers` or
+	:meth:`Love8C.set_register` call, with all its frames and retries.
+	"""
+	
+	def __init__(self):
+		self.count = 0
+		self.results = dict((x, 0) for x in TRANSACTION_RESULTS)
+		self.exception_codes = {}
+		self.frames = 0
+		self.retries = 0
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.latency_sum = 0.0
+		self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+	
+	def add(self, record):
+		self.count += 1
+		self.results[record["result"]] += 1
+		if record["exception_code"] is not None:
+			code = record["exception_code"]
+			self.exception_codes[code] = self.exception_codes.get(code, 0) + 1
+		self.frames += record["frames"]
+		self.retries += record["retries"]
+		self.bytes_sent += record["bytes_sent"]
+		self.bytes_received += record["bytes_received"]
+		self.latency_sum += record["latency"]
+		index = 0
+		while index < len(LATENCY_BUCKETS) and record["latency"] > LATENCY_BUCKETS[index]:
+			index += 1
+		self.buckets[index] += 1
+	
+	def merge(self, other):
+		self.count += other.count
+		for name in TRANSACTION_RESULTS:
+			self.results[name] += other.results[name]
+		for code, count in other.exception_codes.items():
+			self.exception_codes[code] = self.exception_codes.get(code, 0) + count
+		self.frames += other.frames
+		self.retries += other.retries
+		self.bytes_sent += other.bytes_sent
+		self.bytes_received += other.bytes_received
+		self.latency_sum += other.latency_sum
+		self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+	
+	def data(self):
+		"""JSON ready dict, the histogram is cumulative (count of latencies <= le)."""
+		histogram = []
+		total = 0
+		for le, count in zip(LATENCY_BUCKETS + ['+Inf'], self.buckets):
+			total += count
+			histogram.append([le, total])
+		return {
+			"count": self.count,
+			"results": dict(self.results),
+			"exception_codes": dict((str(k), v) for k, v in self.exception_codes.items()),
+			"frames": self.frames,
+			"retries": self.retries,
+			"bytes_sent": self.bytes_sent,
+			"bytes_received": self.bytes_received,
+			"latency_sum": self.latency_sum,
+			"latency_buckets": histogram
+		}
+
+"""Statistics of every device, key: (port name, slave address)."""
+_transaction_stats = {}
+_transaction_lock = threading.Lock()
+
+"""Called as callback(record) after every transaction, see :meth:`Love8C._transaction`."""
+TRANSACTION_CALLBACKS = []
+
+def add_transaction_callback(callback):
+	"""Forward every transaction record (a dict) to callback(record), for external telemetry."""
+	TRANSACTION_CALLBACKS.append(callback)
+
+def remove_transaction_callback(callback):
+	TRANSACTION_CALLBACKS.remove(callback)
+
+def record_transaction(record):
+	"""Add a transaction record to the statistics and pass it to the callbacks."""
+	key = (record["port"], record["address"])
+	with _transaction_lock:
+		if key not in _transaction_stats:
+			_transaction_stats[key] = TransactionStats()
+		_transaction_stats[key].add(record)
+	for callback in list(TRANSACTION_CALLBACKS):
+		try:
+			callback(record)
+		except Exception:
+			#A telemetry failure must not fail the bus
+			pass
+
+def transaction_stats(portname=None):
+	"""Statistics per port and per slave (of one port if given).
+	
+	Returns {"ports": {port: stats}, "devices": [{"port", "address", **stats}]},
+	stats as in :meth:`TransactionStats.data`.
+	"""
+	ports = {}
+	devices = []
+	with _transaction_lock:
+		for key in sorted(_transaction_stats):
+			if portname is not None and key[0] != portname:
+				continue
+			stats = _transaction_stats[key]
+			if key[0] not in ports:
+				ports[key[0]] = TransactionStats()
+			ports[key[0]].merge(stats)
+			device = {"port": key[0], "address": key[1]}
+			device.update(stats.data())
+			devices.append(device)
+	return {"ports": dict((k, v.data()) for k, v in ports.items()), "devices": devices}
+
+def reset_transaction_stats():
+	with _transaction_lock:
+		_transaction_stats.clear()
+
+def char_time(port):
+	"""Seconds to transmit one character with the settings of a serial.Serial."""
+	bits = 1 + port.bytesize + (0 if port.parity == serial.PARITY_NONE else 1) + port.stopbits
+	return bits / float(port.baudrate)
+
+#Serial framing when none is given: the controller default for ASCII, the Modbus standard for RTU
+DEFAULT_FRAMING = {
+			minimalmodbus.MODE_ASCII: '7E1',
+			minimalmodbus.MODE_RTU: '8E1'
+}
+
+#Settings tried by detect_settings, fastest first
+COMM_BAUDRATES = [38400, 19200, 9600, 4800, 2400]
+COMM_FRAMINGS = {
+			minimalmodbus.MODE_RTU: ['8E1', '8N1', '8O1', '8N2'],
+			minimalmodbus.MODE_ASCII: ['7E1', '7O1', '7N2', '8E1', '8N1', '8O1']
+}
+
+def parse_framing(framing, mode=None):
+	"""Parse a framing like '7E1' or '8N2' into (bytesize, parity, stopbits), RTU (*mode*) needs 8 data bits."""
+	framing = framing.upper()
+	if len(framing) != 3 or framing[0] not in '78' or framing[1] not in 'NEO' or framing[2] not in '12':
+		raise ValueError('The framing must be data bits, parity and stop bits, Example: 7E1. Given: {0!r}'.format(framing))
+	if mode == minimalmodbus.MODE_RTU and framing[0] != '8':
+		raise ValueError('The rtu mode needs 8 data bits, Example: 8E1. Given: {0!r}'.format(framing))
+	return int(framing[0]), framing[1], int(framing[2])
+
+
+"""Two upper case hex digits of every byte value."""
+HEX_DIGITS = [('%02X' % i).encode('ascii') for i in range(256)]
+
+class AsciiCodec(object):
+	"""Modbus ASCII codec for the function codes of the Love 8C (3 and 6).
+	
+	Request frames are built from :data:`HEX_DIGITS` and kept, so a poll loop
+	sends the same bytes without encoding them again. The answer is collected in
+	one reusable bytearray, the end of frame is found incrementally as bytes
+	arrive, and the frame is hex decoded from a memoryview of the buffer.
+	"""
+	
+	def __init__(self):
+		self.buffer = bytearray()
+		self.scanned = 0
+		self.end = -1
+		self._requests = {}
+	
+	def request(self, slaveaddress, functioncode, first, second):
+		"""Frame for function 3 (first register, count) or 6 (register, raw value)."""
+		key = (slaveaddress, functioncode, first, second)
+		frame = self._requests.get(key)
+		if frame is None:
+			body = (slaveaddress, functioncode, first >> 8, first & 0xFF, second >> 8, second & 0xFF)
+			frame = b':' + b''.join([HEX_DIGITS[x] for x in body]) + HEX_DIGITS[(-sum(body)) & 0xFF] + b'\r\n'
+			if len(self._requests) < 4096:
+				self._requests[key] = frame
+		return frame
+	
+	def reset(self):
+		del self.buffer[:]
+		self.scanned = 0
+		self.end = -1
+	
+	def feed(self, data):
+		"""Add received bytes, True once a complete frame is in the buffer."""
+		self.buffer += data
+		if self.end < 0:
+			self.end = self.buffer.find(b'\r\n', max(0, self.scanned - 1))
+			self.scanned = len(self.buffer)
+		return self.end >= 0
+	
+	def body(self, slaveaddress, functioncode):
+		"""Checked frame bytes (address, function code, data, LRC) of the buffered answer."""
+		start = self.buffer.find(b':', 0, self.end)
+		if self.end < 0 or start < 0:
+			raise InvalidResponseError('Incomplete answer: {0!r}'.format(bytes(self.buffer)))
+		try:
+			body = binascii.a2b_hex(memoryview(self.buffer)[start + 1:self.end])
+		except (TypeError, ValueError, binascii.Error):
+			raise InvalidResponseError('The response is not hex encoded: {0!r}'.format(bytes(self.buffer)))
+		if len(body) < 4 or sum(bytearray(body)) & 0xFF:
+			raise InvalidResponseError('Wrong LRC in the response: {0!r}'.format(bytes(self.buffer)))
+		body = bytearray(body)
+		if body[0] != slaveaddress:
+			raise InvalidResponseError('Wrong slave address in the response: {0!r}'.format(bytes(self.buffer)))
+		if body[1] == (functioncode | 0x80):
+			raise SlaveReportedException('The slave is indicating an error, exception code {0}'.format(body[2]))
+		if body[1] != functioncode:
+			raise InvalidResponseError('Wrong function code in the response: {0!r}'.format(bytes(self.buffer)))
+		return body
+	
+	def words(self, slaveaddress, count):
+		"""Register values of a function 3 answer."""
+		body = self.body(slaveaddress, 3)
+		if len(body) != 4 + 2 * count or body[2] != 2 * count:
+			raise InvalidResponseError('Wrong number of bytes in the response: {0!r}'.format(bytes(self.buffer)))
+		return list(struct.unpack_from('>%dH' % count, body, 3))
+	
+	def echo(self, slaveaddress, registeraddress, raw):
+		"""Check the echo of a function 6 answer."""
+		body = self.body(slaveaddress, 6)
+		if body[2:6] != bytearray(struct.pack('>HH', registeraddress, raw)):
+			raise InvalidResponseError('The slave did not echo the written register: {0!r}'.format(bytes(self.buffer)))
+
 
 class Love8C( minimalmodbus.Instrument ):
 	"""Instrument class for Love 8C process controller. 
 	
-	Communicates via Modbus ASCII protocol (via RS485), using the :mod:`minimalmodbus` Python module.
+	Communicates via Modbus ASCII (default) or RTU protocol (via RS485), using the :mod:`minimalmodbus` Python module.
 	
 	This driver is intended to enable control of the Love8C controller from the command line.
 	
@@ -367,6 +856,18 @@ class Love8C( minimalmodbus.Instrument ):
 		* Windows: '/com3'
 		
 		* slaveaddress (int): slave address in the range 1 to 247 (in decimal)
+		
+		* mode (str): minimalmodbus.MODE_ASCII or minimalmodbus.MODE_RTU, as set on the controller
+		
+		* baudrate (int): 2400 to 38400, as set on the controller
+		
+		* framing (str): data bits, parity and stop bits, Example: '7E1' (default for the mode in :data:`DEFAULT_FRAMING`)
+		
+		* transport (str): 'minimalmodbus' (default) or 'native', the :class:`AsciiCodec` transport (ASCII mode only)
+		
+		* arbiter: :class:`love8c_arbiter.BusArbiter` of the port shared with other processes,
+		  see :func:`love8c_arbiter.bus_arbiter`. minimalmodbus opens the port when the
+		  instrument is made, so this is done in a turn of the arbiter too.
 			
 	Implemented with these function codes (in decimal):
 		
@@ -379,41 +880,316 @@ class Love8C( minimalmodbus.Instrument ):
 	
 	"""
 	
-	def __init__(self, portname, slaveaddress):
+	def __init__(self, portname, slaveaddress, mode=minimalmodbus.MODE_ASCII, baudrate=9600, framing=None, transport='minimalmodbus', arbiter=None):
+		if transport == 'native' and mode != minimalmodbus.MODE_ASCII:
+			raise ValueError('The native transport is only for the ascii mode')
+		bytesize, parity, stopbits = parse_framing(framing or DEFAULT_FRAMING[mode], mode)
 		self.handle_local_echo = False
 		self.close_port_after_each_call = True
-		minimalmodbus.Instrument.__init__(self, portname, slaveaddress, minimalmodbus.MODE_ASCII)
-		self.serial.baudrate = 9600
-		self.serial.bytesize = 7
-		self.serial.parity = minimalmodbus.serial.PARITY_EVEN
-		self.serial.stopbits = 1
+		if arbiter is not None:
+			def construct():
+				minimalmodbus.Instrument.__init__(self, portname, slaveaddress, mode)
+				self.serial.close()
+			arbiter.run(None, construct)
+		else:
+			minimalmodbus.Instrument.__init__(self, portname, slaveaddress, mode)
+		self.serial.baudrate = baudrate
+		self.serial.bytesize = bytesize
+		self.serial.parity = parity
+		self.serial.stopbits = stopbits
 		self.serial.timeout  = 0.5
 		#self.debug = True
+		self.adaptive_timeout = True
+		self.circuit_breaker = True
+		self.codec = AsciiCodec() if transport == 'native' else None
+		#Times to repeat an unanswered frame
+		self.retries = 0
+		#love8c_arbiter.BusArbiter sharing the port with other processes
+		self.arbiter = arbiter
+		#Exception code of the last answer, None when it was not an exception answer
+		self.last_exception_code = None
+		self._frames = None
+	
+	def _arbitrated(self, operation, method, args):
+		"""Run the operation when the :attr:`arbiter` gives the bus, identical reads share the answer."""
+		key = None
+		if operation == 'get_register':
+			key = '{0}:{1}:{2}'.format(operation, self.address, args[0])
+		elif operation == 'get_registers':
+			key = '{0}:{1}:{2}'.format(operation, self.address, ','.join(args[0]))
+		elif operation == 'get_words':
+			key = '{0}:{1}:{2}:{3}'.format(operation, self.address, args[0], args[1])
+		def run():
+			try:
+				return method(self, *args)
+			finally:
+				self.serial.close()
+		return self.arbiter.run(key, run)
+	
+	def _transaction(self, operation, method, *args):
+		"""Run a register operation and record it with :func:`record_transaction`."""
+		if self._frames is not None:
+			return method(self, *args)
+		self._frames = frames = []
+		start = time.time()
+		error = None
+		try:
+			if self.arbiter is not None:
+				return self._arbitrated(operation, method, args)
+			return method(self, *args)
+		except Exception as ex:
+			error = ex
+			raise
+		finally:
+			self._frames = None
+			record_transaction({
+				"time": start,
+				"port": self.serial.port,
+				"address": self.address,
+				"operation": operation,
+				"latency": time.time() - start,
+				"result": transaction_result(error),
+				"exception_code": frames[-1][3] if frames else None,
+				"frames": len(frames),
+				"retries": sum(x[2] for x in frames),
+				"bytes_sent": sum(x[0] for x in frames),
+				"bytes_received": sum(x[1] for x in frames)
+			})
+	
+	def _communicate(self, request, number_of_bytes_to_read):
+		"""Talk to the slave through minimalmodbus, see :meth:`_exchange`."""
+		return self._exchange(request, number_of_bytes_to_read, minimalmodbus.Instrument._communicate)
+	
+	def _native_communicate(self, request, number_of_bytes_to_read):
+		"""Send a request and collect the answer in the :class:`AsciiCodec` buffer.
+		
+		Stops as soon as the end of frame arrives, also for the short exception
+		answers, instead of waiting for *number_of_bytes_to_read* or the timeout.
+		"""
+		port = self.serial
+		if not port.is_open:
+			port.open()
+		codec = self.codec
+		codec.reset()
+		port.reset_input_buffer()
+		port.write(request)
+		deadline = time.time() + port.timeout
+		while not codec.feed(port.read(port.in_waiting or 1)):
+			if time.time() >= deadline:
+				break
+		if self.close_port_after_each_call:
+			port.close()
+		if not codec.buffer:
+			raise NoResponseError('No communication with the instrument (no answer)')
+		return codec.buffer
+	
+	def _exchange(self, request, number_of_bytes_to_read, communicate):
+		"""Run communicate(self, request, number_of_bytes_to_read) with the adaptive timeout and circuit breaker of :class:`DeviceHealth`.
+		
+		Without :attr:`circuit_breaker` (probes like :func:`detect_settings`) the shared
+		:class:`DeviceHealth` is left as it is, so failed probes never take the device offline.
+		"""
+		health = device_health(self.serial.port, self.address)
+		tchar = char_time(self.serial)
+		#bytes sent, bytes received, retries, exception code
+		frame = [0, 0, 0, None]
+		self.last_exception_code = None
+		if self._frames is not None:
+			self._frames.append(frame)
+		while True:
+			now = time.time()
+			if self.circuit_breaker:
+				health.check(now)
+			if self.adaptive_timeout:
+				self.serial.timeout = (len(request) + min(number_of_bytes_to_read, 600)) * tchar + health.timeout()
+			frame[0] += len(request)
+			try:
+				answer = communicate(self, request, number_of_bytes_to_read)
+			except IOError as ex:
+				if not isinstance(ex, serial.SerialException):
+					if self.circuit_breaker:
+						health.failure(time.time())
+					if isinstance(ex, NoResponseError) and frame[2] < self.retries:
+						frame[2] += 1
+						continue
+				raise
+			break
+		frame[1] += len(answer)
+		frame[3] = self.last_exception_code = response_exception_code(answer, self.mode)
+		if self.circuit_breaker:
+			health.success(max(0.0, time.time() - now - (len(request) + len(answer)) * tchar))
+		return answer
+	
+	def read_registers(self, registeraddress, count, functioncode=3):
+		"""Read *count* raw register values, through the native codec when enabled."""
+		if self.codec is None:
+			return minimalmodbus.Instrument.read_registers(self, registeraddress, count, functioncode)
+		request = self.codec.request(self.address, functioncode, registeraddress, count)
+		self._exchange(request, 11 + 4 * count, Love8C._native_communicate)
+		return self.codec.words(self.address, count)
 	
 	def get_register(self, name):
-		signed = False
-		decimals = REGISTER_READ_DETAIL[name][0]
-		funct = REGISTER_READ_DETAIL[name][1]
-		if (REGISTER_READ_DETAIL[name][2]==1):
-			signed = True
-		return self.read_register( REGISTER_START[name], decimals, funct, signed)
+		return self._transaction('get_register', Love8C._get_register, name)
+	
+	def _get_register(self, name):
+		reg = REGISTERS[name]
+		if self.codec is not None:
+			return reg.decode(self.read_registers(reg.address, 1, reg.functioncode)[0])
+		return self.read_register( reg.address, reg.decimals, reg.functioncode, reg.signed)
+	
+	def get_registers(self, names):
+		"""Read several registers using as few block reads as possible.
+		
+		The names are grouped with :func:`plan_reads` (compiled once per name list by
+		:func:`block_layouts`) and every block is fetched with one function 3 request,
+		instead of one request per register.
+		
+		Returns a dict name -> value, in the order of *names*.
+		"""
+		return self._transaction('get_registers', Love8C._get_registers, names)
+	
+	def _get_registers(self, names):
+		values = {}
+		for layout in block_layouts(names):
+			layout.decode(self.read_registers(layout.start, layout.count, 3), values)
+		data = {}
+		for name in names:
+			data[name] = values[name]
+		return data
 	
 	def set_register(self, name, setpointvalue):
-		tipoPermitido = REGISTER_WRITE_DETAIL[name][0]
-		minimo = REGISTER_WRITE_DETAIL[name][4]
-		maximo = REGISTER_WRITE_DETAIL[name][5]
-		funct = REGISTER_WRITE_DETAIL[name][2]
-		signed = False
-		decimals = REGISTER_WRITE_DETAIL[name][1]
-		if (REGISTER_WRITE_DETAIL[name][3]==1):
-			signed = True
-		if (checkNumerical(setpointvalue, minvalue=minimo, maxvalue=maximo) ):
-			self.write_register( REGISTER_START[name], setpointvalue, decimals, funct, signed)
+		return self._transaction('set_register', Love8C._set_register, name, setpointvalue)
+	
+	def get_words(self, registeraddress, count):
+		"""Read *count* raw register values with one function 3 request, as one transaction (statistics, :attr:`arbiter`)."""
+		return self._transaction('get_words', Love8C.read_registers, registeraddress, count, 3)
+	
+	def set_word(self, registeraddress, raw):
+		"""Write one raw register value with function 6, as one transaction (statistics, :attr:`arbiter`)."""
+		return self._transaction('set_word', Love8C._set_word, registeraddress, raw)
+	
+	def _set_word(self, registeraddress, raw):
+		#The only write path of both transports, so a value is encoded the same way on each
+		if self.codec is not None:
+			self._exchange(self.codec.request(self.address, 6, registeraddress, raw), 17, Love8C._native_communicate)
+			self.codec.echo(self.address, registeraddress, raw)
+		else:
+			self.write_register(registeraddress, raw, 0, 6, False)
+	
+	def broadcast_register(self, name, setpointvalue):
+		"""Write a register of every slave on the port at once, with one frame to :data:`BROADCAST_ADDRESS`.
+		
+		The slaves do not answer a broadcast, so nothing is known about the result:
+		read the register back from each slave to verify it (see
+		:meth:`love8c_bus.Fleet.broadcast`). The range is checked like in
+		:meth:`set_register`. Waits :data:`BROADCAST_DELAY` for the slaves to process it.
+		With an :attr:`arbiter` the frame waits its turn on the bus like any other operation.
+		
+		Returns True if sent, False if the value is out of range.
+		"""
+		if self.arbiter is not None:
+			return self._arbitrated('broadcast_register', Love8C._broadcast_register, (name, setpointvalue))
+		return self._broadcast_register(name, setpointvalue)
+	
+	def _broadcast_register(self, name, setpointvalue):
+		reg = REGISTERS[name]
+		if not reg.writable:
+			raise KeyError(name)
+		if not reg.check(setpointvalue):
+			return False
+		payload = bytearray(struct.pack('>HH', reg.address, reg.encode(setpointvalue)))
+		if self.mode == minimalmodbus.MODE_RTU:
+			request = rtu_frame(BROADCAST_ADDRESS, 6, payload)
+		else:
+			request = ascii_frame(BROADCAST_ADDRESS, 6, payload)
+		port = self.serial
+		if not port.is_open:
+			port.open()
+		try:
+			port.write(request)
+			port.flush()
+			time.sleep(BROADCAST_DELAY)
+		finally:
+			if self.close_port_after_each_call:
+				port.close()
+		return True
+	
+	def _set_register(self, name, setpointvalue):
+		reg = REGISTERS[name]
+		if not reg.writable:
+			raise KeyError(name)
+		if (reg.check(setpointvalue) ):
+			self._set_word(reg.address, reg.encode(setpointvalue))
 			return True
 		else:
 			return False
 
 
+class RegisterCache(object):
+	"""Caching layer around a :class:`Love8C` (or any object with the same get/set methods).
+	
+	A read is answered from the cache while the value is younger than its ttl, only
+	the stale registers go to the bus (still with block reads). A successful
+	set_register updates the cached value, or drops it for the registers in
+	:data:`CACHE_INVALIDATE_ON_WRITE`. Other attributes are taken from the instrument.
+	
+	Args:
+		* instrument: the :class:`Love8C` to read through
+		* ttl (dict): register name -> seconds (None until invalidated), overrides :data:`REGISTER_CACHE_TTL`
+		* default_ttl (float): seconds for the registers without an entry in *ttl*
+	"""
+	
+	def __init__(self, instrument, ttl=None, default_ttl=CACHE_TTL_DEFAULT):
+		self.instrument = instrument
+		self.ttl = dict(REGISTER_CACHE_TTL)
+		if ttl:
+			self.ttl.update(ttl)
+		self.default_ttl = default_ttl
+		self.values = {}
+	
+	def __getattr__(self, attr):
+		return getattr(self.instrument, attr)
+	
+	def is_fresh(self, name, now):
+		if name not in self.values:
+			return False
+		ttl = self.ttl.get(name, self.default_ttl)
+		return ttl is None or (now - self.values[name][1]) < ttl
+	
+	def get_register(self, name):
+		return self.get_registers([name])[name]
+	
+	def get_registers(self, names):
+		now = time.time()
+		stale = [x for x in names if not self.is_fresh(x, now)]
+		if stale:
+			for name, value in self.instrument.get_registers(stale).items():
+				self.values[name] = (value, now)
+		data = {}
+		for name in names:
+			data[name] = self.values[name][0]
+		return data
+	
+	def set_register(self, name, setpointvalue):
+		try:
+			result = self.instrument.set_register(name, setpointvalue)
+		except Exception:
+			self.invalidate(name)
+			raise
+		if result and (name in REGISTER_READ_DETAIL) and (name not in CACHE_INVALIDATE_ON_WRITE):
+			self.values[name] = (decode_register(name, encode_register(name, setpointvalue)), time.time())
+		else:
+			self.invalidate(name)
+		return result
+	
+	def invalidate(self, name=None):
+		"""Drop one cached register, or all of them."""
+		if name is None:
+			self.values = {}
+		else:
+			self.values.pop(name, None)
+
+
 def checkNumerical(inputvalue, minvalue=None, maxvalue=None):
 	if not isinstance(inputvalue, (int, long, float)):
 		raise TypeError('The {0} must be numerical. Given: {1!r}'.format(description, inputvalue))
@@ -432,25 +1208,340 @@ def checkNumerical(inputvalue, minvalue=None, maxvalue=None):
 			return False
 	return True
 
-def serial_ports():
+#Block reads: max unmapped registers read between two names and max registers per request
+BLOCK_MAX_GAP = 1
+BLOCK_MAX_REGISTERS = 32
+
+def plan_reads(names, max_gap=BLOCK_MAX_GAP, max_count=BLOCK_MAX_REGISTERS):
+	"""Group register names into runs of nearby addresses.
+	
+	Two addresses go in the same run when at most *max_gap* unused registers lie
+	between them and the run stays within *max_count* registers. With the default
+	values the map is read as 0x4700-0x470B, 0x470E-0x471E, 0x4729-0x472B and 0x4731.
+	
+	Returns a list of (start address, register count, [names]).
+	"""
+	by_address = {}
+	for name in names:
+		address = REGISTERS[name].address
+		by_address.setdefault(address, [])
+		if name not in by_address[address]:
+			by_address[address].append(name)
+	plan = []
+	for address in sorted(by_address):
+		if plan:
+			start, count, block_names = plan[-1]
+			end = start + count - 1
+			if (address - end - 1 <= max_gap) and (address - start + 1 <= max_count):
+				plan[-1] = (start, address - start + 1, block_names + by_address[address])
+				continue
+		plan.append((address, 1, list(by_address[address])))
+	return plan
+
+def decode_register(name, raw):
+	"""Scale a raw 16 bit register value like :meth:`Love8C.get_register` does."""
+	return REGISTERS[name].decode(raw)
+
+def lrc(data):
+	"""Modbus ASCII longitudinal redundancy check of a bytearray."""
+	return (-sum(data)) & 0xFF
+
+def ascii_frame(slaveaddress, functioncode, payload):
+	"""Build the Modbus ASCII request bytes ':AAFF<payload>LL\\r\\n' for a payload bytearray."""
+	body = bytearray([slaveaddress, functioncode]) + payload
+	body.append(lrc(body))
+	return b':' + binascii.hexlify(bytes(body)).upper() + b'\r\n'
+
+def ascii_payload(frame, slaveaddress, functioncode):
+	"""Check a Modbus ASCII response frame and return its payload as a bytearray."""
+	frame = bytes(frame).strip()
+	if not frame.startswith(b':'):
+		raise InvalidResponseError('Did not find the start character in the response: {0!r}'.format(frame))
+	try:
+		body = bytearray(binascii.unhexlify(frame[1:]))
+	except (TypeError, ValueError):
+		raise InvalidResponseError('The response is not hex encoded: {0!r}'.format(frame))
+	if len(body) < 4 or lrc(body[:-1]) != body[-1]:
+		raise InvalidResponseError('Wrong LRC in the response: {0!r}'.format(frame))
+	if body[0] != slaveaddress:
+		raise InvalidResponseError('Wrong slave address in the response: {0!r}'.format(frame))
+	if body[1] == (functioncode | 0x80):
+		raise SlaveReportedException('The slave is indicating an error, exception code {0}'.format(body[2]))
+	if body[1] != functioncode:
+		raise InvalidResponseError('Wrong function code in the response: {0!r}'.format(frame))
+	return body[2:-1]
+
+def encode_register(name, value):
+	"""Raw 16 bit register value for writing *value* to *name*, see :func:`decode_register`."""
+	return REGISTERS[name].encode(value)
+
+def crc16(data):
+	"""Modbus RTU CRC of a bytearray."""
+	crc = 0xFFFF
+	for byte in data:
+		crc ^= byte
+		for i in range(8):
+			if crc & 1:
+				crc = (crc >> 1) ^ 0xA001
+			else:
+				crc >>= 1
+	return crc
+
+def rtu_frame(slaveaddress, functioncode, payload):
+	"""Build the Modbus RTU bytes (address, function code, payload, CRC) for a payload bytearray."""
+	body = bytearray([slaveaddress, functioncode]) + payload
+	crc = crc16(body)
+	body.append(crc & 0xFF)
+	body.append(crc >> 8)
+	return bytes(body)
+
+#Modbus broadcast: every slave executes the write and none answers
+BROADCAST_ADDRESS = 0
+#Seconds to keep the bus quiet after a broadcast, the Modbus turnaround delay
+BROADCAST_DELAY = 0.1
+
+def detect_settings(portname, slaveaddress, timeout=0.1):
+	"""Find the mode, baud rate and framing a controller answers on, fastest first.
+	
+	The register map has no communication registers, the protocol, baud rate and
+	framing are changed from the front panel of the controller. After moving a
+	controller to faster settings (RTU, 38400) use this to confirm them, then pass
+	them to :class:`Love8C` or to the -mode, -baudrate and -framing options.
+	
+	Returns a dict with mode, baudrate and framing, or None if nothing answers.
+	"""
+	for baudrate in COMM_BAUDRATES:
+		for mode in (minimalmodbus.MODE_RTU, minimalmodbus.MODE_ASCII):
+			for framing in COMM_FRAMINGS[mode]:
+				instr = Love8C(portname, slaveaddress, mode, baudrate, framing)
+				instr.adaptive_timeout = False
+				instr.circuit_breaker = False
+				instr.serial.timeout = timeout
+				try:
+					instr.get_register('software_version')
+				except (IOError, ValueError):
+					continue
+				finally:
+					instr.serial.close()
+				return {"mode": mode, "baudrate": baudrate, "framing": framing}
+	return None
+
+def error_data(ex):
+	"""Build the JSON error dict printed by the command line for an exception."""
+	data = {}
+	if isinstance(ex, (OSError, serial.SerialException)):
+		data["error"] = "port"
+		data["msg"] = ex.__str__()
+		errcode = 0
+		if "WindowsError(2," in data["msg"]:
+			errcode = 2 #No existe el puerto
+		if "WindowsError(5," in data["msg"]:
+			errcode = 5 #En uso
+		data["code"] = errcode
+	else:
+		data["error"] = "unknow"
+		data["code"] = 0
+		data["msg"] = ex.__str__()
+	return data
+
+def readback_value(name, value):
+	"""Value read from *name* after writing *value* to it (scaled like the device stores it)."""
+	if name == 'lock_status':
+		for key, label in LOCK_STATUS_READ.items():
+			if label == LOCK_STATUS_SET.get(int(value)):
+				return key
+	return decode_register(name, encode_register(name, value))
+
+def load_profile(path):
+	"""Load a controller profile, register name -> value, from a JSON or INI file.
+	
+	INI files take the keys of every section, in file order::
+	
+		[profile]
+		set_point = 18.5
+		alarm_1_type = 2
+	"""
+	if path.lower().endswith('.ini'):
+		try:
+			import configparser
+		except ImportError:
+			import ConfigParser as configparser
+		parser = configparser.RawConfigParser()
+		parser.optionxform = str
+		parser.read(path)
+		items = []
+		for section in parser.sections():
+			items.extend(parser.items(section))
+	else:
+		with open(path) as f:
+			items = list(json.load(f, object_pairs_hook=lambda x: x))
+	profile = []
+	for name, value in items:
+		if name not in REGISTER_WRITE_DETAIL:
+			raise ValueError('Not a writable register: {0}'.format(name))
+		profile.append((name, float(value)))
+	return profile
+
+def apply_profile(instr, profile, verify=True):
+	"""Write only the registers of *profile* that differ from the controller.
+	
+	The current values are read with :meth:`Love8C.get_registers`, the differing
+	registers are written in profile order and, if *verify*, read back.
+	
+	Args:
+		* instr: the :class:`Love8C` (or :class:`RegisterCache`)
+		* profile: list of (name, value) or dict, see :func:`load_profile`
+	
+	Returns a dict with the "unchanged" names, the "written" name -> value and the
+	"failed" name -> value (out of range, or a different value read back).
+	"""
+	if isinstance(profile, dict):
+		profile = list(profile.items())
+	names = [name for name, value in profile]
+	current = instr.get_registers(names)
+	result = {"unchanged": [], "written": {}, "failed": {}}
+	for name, value in profile:
+		if current[name] == readback_value(name, value):
+			result["unchanged"].append(name)
+		elif instr.set_register(name, value):
+			result["written"][name] = value
+		else:
+			result["failed"][name] = value
+	if verify and result["written"]:
+		if isinstance(instr, RegisterCache):
+			for name in result["written"]:
+				instr.invalidate(name)
+		check = instr.get_registers(list(result["written"]))
+		for name in list(result["written"]):
+			if check[name] != readback_value(name, result["written"][name]):
+				result["failed"][name] = result["written"].pop(name)
+	return result
+
+#Seconds a port listing is reused, in the process and in PORTS_CACHE_FILE (per user, None if unsafe) for the next calls
+PORTS_CACHE_SECONDS = love8c_fast.PORTS_CACHE_SECONDS
+PORTS_CACHE_FILE = love8c_fast.ports_cache_file()
+PROBE_TIMEOUT = 0.5
+
+_ports_cache = {}
+
+def serial_port_info():
+	"""Serial hardware of the system, from the OS metadata (sysfs, SetupAPI, IOKit).
+	
+	No port is opened. Returns a list of dicts with port, description, hwid, vid,
+	pid and driver (Linux only, None elsewhere).
+	"""
+	from serial.tools import list_ports
+	info = []
+	for port in sorted(list_ports.comports(), key=lambda x: x.device):
+		info.append({
+			"port": port.device,
+			"description": port.description,
+			"hwid": port.hwid,
+			"vid": port.vid,
+			"pid": port.pid,
+			"driver": port_driver(port.device)
+		})
+	return info
+
+def port_driver(device):
+	"""Kernel driver of a Linux tty (ftdi_sio, cp210x, ch341-uart...), None if unknown."""
+	link = os.path.join('/sys/class/tty', os.path.basename(device), 'device', 'driver')
+	if not os.path.exists(link):
+		return None
+	return os.path.basename(os.path.realpath(link))
+
+def probe_ports(ports, timeout=PROBE_TIMEOUT):
+	"""Return the ports of *ports* that can be opened, all tried at the same time.
+	
+	A port still opening after *timeout* seconds is left out.
+	"""
+	opened = {}
+	def probe(port):
+		try:
+			s = serial.Serial(port)
+			s.close()
+			opened[port] = True
+		except (OSError, serial.SerialException):
+			pass
+	threads = []
+	for port in ports:
+		thread = threading.Thread(target=probe, args=(port,))
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	deadline = time.time() + timeout
+	for thread in threads:
+		thread.join(max(0, deadline - time.time()))
+	return [x for x in ports if x in opened]
+
+def candidate_ports():
+	"""Device names that may be serial ports, to probe when the OS metadata is not available."""
+	import glob
 	if sys.platform.startswith('win'):
-		ports = ['COM%s' % (i + 1) for i in range(256)]
+		return ['COM%s' % (i + 1) for i in range(256)]
 	elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
 		# this excludes your current terminal "/dev/tty"
-		ports = glob.glob('/dev/tty[A-Za-z]*')
+		return glob.glob('/dev/tty[A-Za-z]*')
 	elif sys.platform.startswith('darwin'):
-		ports = glob.glob('/dev/tty.*')
+		return glob.glob('/dev/tty.*')
 	else:
 		raise EnvironmentError('Unsupported platform')
-	result = []
-	for port in ports:
+
+def serial_ports(max_age=PORTS_CACHE_SECONDS, probe=False):
+	"""List the serial ports of the system.
+	
+	The ports come from :func:`serial_port_info`; with *probe* (or when
+	``serial.tools.list_ports`` is missing) the candidate device names are opened
+	concurrently instead and only the free ones are listed. Listings younger than
+	*max_age* seconds are answered from the cache.
+	"""
+	now = time.time()
+	cached = _ports_cache.get(probe)
+	if cached is None and PORTS_CACHE_FILE is not None:
 		try:
-			s = serial.Serial(port)
-			s.close()
-			result.append(port)
-		except (OSError, serial.SerialException):
+			with open(PORTS_CACHE_FILE) as f:
+				cached = json.load(f).get(str(probe))
+		except (IOError, OSError, ValueError, AttributeError):
+			cached = None
+	if cached is not None and 0 <= now - cached[0] < max_age:
+		return list(cached[1])
+	result = None
+	if not probe:
+		try:
+			result = [x["port"] for x in serial_port_info()]
+		except ImportError:
+			result = None
+	if result is None:
+		result = probe_ports(candidate_ports())
+	_ports_cache[probe] = (now, result)
+	if PORTS_CACHE_FILE is not None:
+		save_ports_cache(probe, now, result)
+	return list(result)
+
+def save_ports_cache(probe, now, result):
+	"""Add a listing to PORTS_CACHE_FILE, written to a new file then renamed over the old one."""
+	import tempfile
+	try:
+		with open(PORTS_CACHE_FILE) as f:
+			data = json.load(f)
+		if not isinstance(data, dict):
+			data = {}
+	except (IOError, OSError, ValueError):
+		data = {}
+	data[str(probe)] = (now, result)
+	try:
+		fd, path = tempfile.mkstemp(dir=os.path.dirname(PORTS_CACHE_FILE))
+	except (IOError, OSError):
+		return
+	try:
+		with os.fdopen(fd, 'w') as f:
+			json.dump(data, f)
+		getattr(os, 'replace', os.rename)(path, PORTS_CACHE_FILE)
+	except (IOError, OSError):
+		try:
+			os.remove(path)
+		except OSError:
 			pass
-	return result
 
 
 ########################
@@ -458,6 +1549,8 @@ def serial_ports():
 ########################
 
 if __name__ == '__main__':
+	import argparse
+	
 	#PORTNAME = 'COM3'
 	#PORTNAME = '/dev/ttyUSB0'
 	#ADDRESS = 1
@@ -473,16 +1566,233 @@ if __name__ == '__main__':
 	parser.add_argument("-j", "--json", action="count", default=0, help='Encode out to json')
 	parser.add_argument("-t", "--test", action="count", default=0)
 	parser.add_argument("-e", "--emu", action="count", default=0)
+	parser.add_argument('-profile', metavar='file', nargs=1, help='Write the registers of a JSON or INI profile that differ from the device, Example: recipe.json')
+	parser.add_argument("--probe", action="count", default=0, help='List only the ports that can be opened, trying every device node')
+	parser.add_argument("-scan", action="count", default=0, help='Find the devices on -port (Example: COM3,COM4) or -bus, -addresses limits the probed addresses')
+	parser.add_argument("--serve", action="count", default=0, help='Run as daemon keeping the ports open, -port limits the ports served (Example: COM3,COM4)')
+	parser.add_argument("--cache", action="count", default=0, help='Answer daemon reads from a per register cache (see REGISTER_CACHE_TTL)')
+	parser.add_argument('-listen', metavar='host:port', nargs=1, help='Daemon HTTP address, Example: 127.0.0.1:8988')
+	parser.add_argument("--poll", action="count", default=0, help='Poll -addresses on -port, one json line per read, -get limits the registers')
+	parser.add_argument('-addresses', metavar='list', nargs=1, help='Device addresses for --poll, Example: 1,2,5-8')
+	parser.add_argument('-bus', metavar='port:list', action='append', help='Port and device addresses of a bus, one worker per bus, repeat for each port, Example: COM3:1-4')
+	parser.add_argument('-mode', metavar='mode', nargs=1, choices=[minimalmodbus.MODE_ASCII, minimalmodbus.MODE_RTU], default=[minimalmodbus.MODE_ASCII], help='Modbus protocol set on the devices: ascii (default) or rtu')
+	parser.add_argument('-baudrate', metavar='baud', nargs=1, type=int, default=[9600], help='Baud rate set on the devices, Example: 38400')
+	parser.add_argument('-framing', metavar='framing', nargs=1, help='Data bits, parity and stop bits, Example: 8N1 (7E1 for ascii, 8E1 for rtu by default)')
+	parser.add_argument('-transport', metavar='transport', nargs=1, choices=['minimalmodbus', 'native'], default=['minimalmodbus'], help='Modbus ASCII implementation: minimalmodbus (default) or native')
+	parser.add_argument("--log", action="count", default=0, help='Log -get registers (process_value,set_point,output,leds by default) of -bus or -port/-addresses to binary files, see love8c_log.py')
+	parser.add_argument('-log_dir', metavar='dir', nargs=1, default=['logs'], help='Directory of the --log files, Example: /var/log/love8c')
+	parser.add_argument('-interval', metavar='seconds', nargs=1, type=float, default=[1.0], help='Sample period of --log, Example: 5')
+	parser.add_argument("--metrics", action="count", default=0, help='Poll -bus or -port/-addresses and serve Prometheus metrics on -listen (default 127.0.0.1:9688) at /metrics')
+	parser.add_argument("--watch", action="count", default=0, help='Poll -bus or -port/-addresses, one json line per change of -get registers (process_value,status,leds,lock_status by default)')
+	parser.add_argument('-deadband', metavar='value', nargs=1, type=float, help='Smallest process_value change reported by --watch, Example: 0.2 (default 0.5)')
+	parser.add_argument("--broadcast", action="count", default=0, help='Write -set/-set_value to every device of -bus or -port/-addresses with one broadcast frame, then read it back from each')
+	parser.add_argument("--no_verify", action="count", default=0, help='Do not read back a --broadcast write')
+	parser.add_argument("--arbitrate", action="count", default=0, help='Wait for the turn on the port when other love8c processes use it (FIFO, see love8c_arbiter.py)')
+	parser.add_argument("--gateway", action="count", default=0, help='Modbus TCP gateway on -listen (default 127.0.0.1:5020) to the devices of -bus or -port/-addresses, unit id = device address')
+	parser.add_argument('-freshness', metavar='seconds', nargs=1, type=float, help='Seconds the --gateway answers repeated reads from the last response, Example: 1 (default 0.5)')
+	parser.add_argument("--stats", action="count", default=0, help='Print the transaction statistics per port and device (latency histogram, bytes, retries, errors) at the end')
+	parser.add_argument('-retries', metavar='n', nargs=1, type=int, default=[0], help='Repeat unanswered requests n times, Example: 2')
+	parser.add_argument("-detect", action="count", default=0, help='Find the protocol, baud rate and framing of the device on -port and -address')
 	
 	
 	args = parser.parse_args()
 	
+	framing = None
+	if (args.framing != None):
+		framing = args.framing[0]
+	def connect(portname, address):
+		arbiter = None
+		if (args.arbitrate):
+			import love8c_arbiter
+			arbiter = love8c_arbiter.bus_arbiter(portname)
+		instr = Love8C(portname, address, args.mode[0], args.baudrate[0], framing, args.transport[0], arbiter)
+		instr.retries = args.retries[0]
+		return instr
+	
+	def print_stats():
+		if (args.stats):
+			minimalmodbus._print_out(json.dumps({"stats": transaction_stats()}))
+	
+	if (args.serve):
+		import love8c_server
+		ports = None
+		if (args.port != None):
+			ports = [x.strip() for x in args.port[0].split(",")]
+		listen = love8c_server.DEFAULT_LISTEN
+		if (args.listen != None):
+			listen = args.listen[0]
+		love8c_server.serve(listen, ports, args.cache > 0, connect)
+		exit()
+	
+	def selected_buses():
+		"""Port -> addresses of -bus, or of -port with -addresses (or -address)."""
+		import love8c_bus
+		buses = {}
+		if (args.port != None):
+			if (args.addresses != None):
+				buses[args.port[0]] = love8c_bus.parse_addresses(args.addresses[0])
+			elif (args.address != None):
+				buses[args.port[0]] = args.address
+		if (args.bus):
+			buses.update(love8c_bus.parse_buses(args.bus))
+		if not buses:
+			minimalmodbus._print_out("Need set the devices, Ex: -bus COM3:1-4")
+			exit()
+		return buses
+	
+	if (args.log):
+		import love8c_log
+		buses = selected_buses()
+		names = None
+		if (args.get != None and args.get[0] != "all"):
+			names = [x.strip() for x in args.get[0].split(",")]
+		def print_error(portname, address, data):
+			minimalmodbus._print_out(json.dumps({"port": portname, "address": address, "data": data}))
+			sys.stdout.flush()
+		try:
+			love8c_log.log(buses, args.log_dir[0], names, args.interval[0], connect, on_error=print_error)
+		except KeyboardInterrupt:
+			pass
+		exit()
+	
+	if (args.watch):
+		import love8c_watch
+		buses = selected_buses()
+		names = None
+		if (args.get != None and args.get[0] != "all"):
+			names = [x.strip() for x in args.get[0].split(",")]
+		deadbands = None
+		if (args.deadband != None):
+			deadbands = {"process_value": args.deadband[0]}
+		def print_event(event):
+			minimalmodbus._print_out(json.dumps(event))
+			sys.stdout.flush()
+		try:
+			love8c_watch.watch(buses, print_event, names, deadbands, instrument_factory=connect)
+		except KeyboardInterrupt:
+			pass
+		print_stats()
+		exit()
+	
+	if (args.gateway):
+		import love8c_gateway
+		buses = selected_buses()
+		listen = love8c_gateway.DEFAULT_GATEWAY_LISTEN
+		if (args.listen != None):
+			listen = args.listen[0]
+		freshness = love8c_gateway.GATEWAY_FRESHNESS
+		if (args.freshness != None):
+			freshness = args.freshness[0]
+		love8c_gateway.serve_gateway(buses, listen, connect, freshness)
+		exit()
+	
+	if (args.metrics):
+		import love8c_metrics
+		buses = selected_buses()
+		listen = love8c_metrics.DEFAULT_METRICS_LISTEN
+		if (args.listen != None):
+			listen = args.listen[0]
+		love8c_metrics.serve_metrics(buses, listen, instrument_factory=connect)
+		exit()
+	
+	if (args.scan):
+		import love8c_bus
+		candidates = list(range(1, 248))
+		if (args.addresses != None):
+			candidates = love8c_bus.parse_addresses(args.addresses[0])
+		buses = {}
+		if (args.port != None):
+			for portname in [x.strip() for x in args.port[0].split(",")]:
+				buses[portname] = candidates
+		if (args.bus):
+			buses.update(love8c_bus.parse_buses(args.bus))
+		if not buses:
+			minimalmodbus._print_out("Need set the port, Ex: -port COM3")
+			exit()
+		try:
+			for portname, device in love8c_bus.Fleet(buses, connect).scan():
+				line = {"port": portname}
+				line.update(device)
+				minimalmodbus._print_out(json.dumps(line))
+				sys.stdout.flush()
+		except KeyboardInterrupt:
+			pass
+		print_stats()
+		exit()
+	
+	if (args.broadcast):
+		import love8c_bus
+		if (args.set == None or args.set_value == None):
+			minimalmodbus._print_out("Need set the register and value, Ex: -set set_point -set_value 15.5")
+			exit()
+		buses = selected_buses()
+		try:
+			for portname, address, data in love8c_bus.Fleet(buses, connect).broadcast(args.set[0], args.set_value[0], args.no_verify == 0):
+				minimalmodbus._print_out(json.dumps({"port": portname, "address": address, "data": data}))
+				sys.stdout.flush()
+		except KeyboardInterrupt:
+			pass
+		print_stats()
+		exit()
+	
+	if (args.bus):
+		import love8c_bus
+		def print_bus(portname, address, data, timestamp=None):
+			line = {"port": portname, "address": address, "data": data}
+			if timestamp is not None:
+				line["time"] = timestamp
+			minimalmodbus._print_out(json.dumps(line))
+			sys.stdout.flush()
+		names = None
+		if (args.get != None and args.get[0] != "all"):
+			names = [x.strip() for x in args.get[0].split(",")]
+		fleet = love8c_bus.Fleet(love8c_bus.parse_buses(args.bus), connect)
+		try:
+			if (args.profile):
+				profile = load_profile(args.profile[0])
+				for portname, address, data in fleet.each(lambda instr: apply_profile(instr, profile)):
+					print_bus(portname, address, data)
+			elif (args.poll):
+				fleet.poll(print_bus, names)
+			else:
+				for portname, address, data in fleet.snapshot(names):
+					print_bus(portname, address, data)
+		except KeyboardInterrupt:
+			pass
+		print_stats()
+		exit()
+	
+	if (args.poll and args.port != None):
+		import love8c_bus
+		def print_poll(address, data, timestamp):
+			minimalmodbus._print_out(json.dumps({"port": args.port[0], "address": address, "time": timestamp, "data": data}))
+			sys.stdout.flush()
+		if (args.addresses != None):
+			addresses = love8c_bus.parse_addresses(args.addresses[0])
+		elif (args.address != None):
+			addresses = args.address
+		else:
+			minimalmodbus._print_out("Need set the addresses, Ex: -addresses 1,2,5-8")
+			exit()
+		names = None
+		if (args.get != None and args.get[0] != "all"):
+			names = [x.strip() for x in args.get[0].split(",")]
+		try:
+			scheduler = love8c_bus.BusScheduler(args.port[0], addresses, names, callback=print_poll, instrument_factory=connect)
+			scheduler.run()
+		except KeyboardInterrupt:
+			pass
+		except Exception as ex:
+			minimalmodbus._print_out(json.dumps(error_data(ex)))
+		print_stats()
+		exit()
+	
 	if (args.port == None):
 		data = {}
-		data["ports"] = serial_ports()
+		data["ports"] = serial_ports(probe=args.probe > 0)
 		if (args.json):
 			if (args.emu):
-				minimalmodbus._print_out("{\"ports\":[\"COM99\"]}")
+				minimalmodbus._print_out(love8c_fast.EMU_PORTS)
 				exit()
 			json_data = json.dumps(data)
 			minimalmodbus._print_out(json_data)
@@ -501,13 +1811,31 @@ if __name__ == '__main__':
 	ADDRESS = args.address[0]
 	
 	try:
+		if (args.detect):
+			data = detect_settings(PORTNAME, ADDRESS)
+			if data is None:
+				data = {"error": "detect", "code": 0, "msg": "No answer with any setting"}
+			minimalmodbus._print_out(json.dumps(data))
+		
+		if (args.profile):
+			instr = connect(PORTNAME, ADDRESS)
+			data = apply_profile(instr, load_profile(args.profile[0]))
+			instr.serial.close()
+			if (args.json):
+				minimalmodbus._print_out(json.dumps(data))
+			else:
+				for name in data["written"]:
+					minimalmodbus._print_out(name + ":" + str(data["written"][name]))
+				for name in data["failed"]:
+					minimalmodbus._print_out("Failed " + name + ":" + str(data["failed"][name]))
+		
 		if (args.set):
 			name = args.set[0]
 			if (args.set_value):
 				if (args.emu):
 					exit()
 				setval = args.set_value[0]
-				instr = Love8C(PORTNAME, ADDRESS)
+				instr = connect(PORTNAME, ADDRESS)
 				instr.set_register(name, setval)
 				instr.serial.close()
 			else:
@@ -516,9 +1844,7 @@ if __name__ == '__main__':
 		if (args.get):
 			data = {}
 			if (args.emu):
-				emu = '{"i_offset":0,"output":0, "control_output": 0,"process_value": 17.4, "upper_limit_alarm_1": 2.0, "temperature_unit_display_selection": 1, "at_setting": 0, "heating_cooling_hysteresis": 0.1, "alarm_2_type": 1, "temperature_regulation_value": 0.0, "ti_integral_time": 10, "alarm_1_type": 1, "lower_limit_alarm_2": 3.0, "lower_limit_alarm_1": 2.0, "control_method": 1, "td_derivative_time": 41, "status": 0, "lower_limit_of_temperature_range": -20.0, "software_version": 1056, "upper_limit_of_temperature_range": 500.0, "communication_write_in_selection": 1, "heating_cooling_control_cycle": 22, "heating_cooling_control_selection": 1, "control_run_stop_setting": 0, "set_point": 18.5, "proportional_control_offset_error_value": 0.0, "upper_limit_alarm_2": 3.0, "input_temperature_sensor_type": 14, "pb_proportional_band": 2.0, "leds": 84,"lock_status":0}'
-				if (ADDRESS==2):
-					emu = '{"i_offset":0,"output":0, "control_output": 0,"process_value": 1.4, "upper_limit_alarm_1": 2.0, "temperature_unit_display_selection": 1, "at_setting": 0, "heating_cooling_hysteresis": 0.1, "alarm_2_type": 1, "temperature_regulation_value": 0.0, "ti_integral_time": 10, "alarm_1_type": 1, "lower_limit_alarm_2": 3.0, "lower_limit_alarm_1": 2.0, "control_method": 1, "td_derivative_time": 41, "status": 0, "lower_limit_of_temperature_range": -20.0, "software_version": 1056, "upper_limit_of_temperature_range": 500.0, "communication_write_in_selection": 1, "heating_cooling_control_cycle": 22, "heating_cooling_control_selection": 1, "control_run_stop_setting": 1, "set_point": 1.5, "proportional_control_offset_error_value": 0.0, "upper_limit_alarm_2": 3.0, "input_temperature_sensor_type": 14, "pb_proportional_band": 2.0, "leds": 84,"lock_status":0}'
+				emu = love8c_fast.emu_answer(ADDRESS)
 				if (args.get[0] == "all"):
 					minimalmodbus._print_out(emu)
 					exit()			
@@ -537,17 +1863,17 @@ if __name__ == '__main__':
 					minimalmodbus._print_out(json_data)
 				exit()
 			
-			instr = Love8C(PORTNAME, ADDRESS)
+			instr = connect(PORTNAME, ADDRESS)
 			if (args.get[0] == "all"):
-				for name in REGISTER_READ_DETAIL:
-					data[name] = instr.get_register(name)
+				data = instr.get_registers(list(REGISTER_READ_DETAIL))
 				if (args.json == 0):
-					minimalmodbus._print_out( str(REGISTER_LABELS[name]) + ': ' + str(data[name]))
+					for name in data:
+						minimalmodbus._print_out( str(REGISTER_LABELS[name]) + ': ' + str(data[name]))
 			else:
 				names = [x.strip() for x in args.get[0].split(",")] #obtengo array de props sin espacios
-				for propName in names:
-					data[propName] = instr.get_register(propName)
-					if (args.json == 0):
+				data = instr.get_registers(names)
+				if (args.json == 0):
+					for propName in names:
 						minimalmodbus._print_out(propName + ":" + str(data[propName]))
 			instr.serial.close()
 			if (args.json):
@@ -557,7 +1883,7 @@ if __name__ == '__main__':
 		if (args.test):
 			minimalmodbus._print_out('TESTING LOVE 8C MODBUS MODULE')
 			minimalmodbus._print_out( 'Port: ' +  str(PORTNAME) + ', Address: ' + str(ADDRESS) )
-			instr = Love8C(PORTNAME, ADDRESS)
+			instr = connect(PORTNAME, ADDRESS)
 			
 			data = {}
 			#json_data = json.dumps(data)
@@ -566,25 +1892,10 @@ if __name__ == '__main__':
 				minimalmodbus._print_out( str(REGISTER_LABELS[name]) + ': ' + str(data[name]))
 			minimalmodbus._print_out('DONE!')
 			instr.serial.close()
-	except (OSError, serial.SerialException) as ex:
-		data = {}
-		data["error"] = "port"
-		data["msg"] = ex.__str__()
-		errcode = 0
-		if "WindowsError(2," in data["msg"]:
-			errcode = 2 #No existe el puerto
-		if "WindowsError(5," in data["msg"]:
-			errcode = 5 #En uso
-		data["code"] = errcode
-		json_data = json.dumps(data)
-		minimalmodbus._print_out(json_data)
-	except Exception as e:
-		data = {}
-		data["error"] = "unknow"
-		data["code"] = 0
-		data["msg"] = e.__str__()
-		json_data = json.dumps(data)
+	except Exception as ex:
+		json_data = json.dumps(error_data(ex))
 		minimalmodbus._print_out(json_data)
+	print_stats()
 
 pass
 """
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Access to a serial port shared by several processes, enabled with ``love8c.py --arbitrate``.
+
+Every register operation of a :class:`love8c.Love8C` with an ``arbiter`` waits
+its turn for the bus:
+
+* Threads of the process wait in a local FIFO queue.
+* Processes of the user wait in a FIFO queue kept in a file of its private
+  directory (:func:`love8c_fast.private_dir`, mode 0700). A waiter
+  refreshes its entry while it waits, and an entry not refreshed for
+  :data:`ARBITER_STALE` seconds (a killed process) is dropped.
+* The first of the queue takes an OS lock (flock, or msvcrt on Windows) on the
+  owner file for the whole operation, released by the OS if the process dies.
+* A read identical to one already running in the process waits for its answer.
+  A read identical to one started by another process after this one was asked
+  takes its answer from the queue file, without using the bus.
+
+The port is closed after every operation, so the next process can open it
+(Windows does not share serial ports). Waits are bounded, :class:`BusBusyError`
+is raised after *timeout* seconds.
+
+"""
+
+import os
+import re
+import json
+import time
+import threading
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+	import msvcrt
+
+import love8c_fast
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Seconds to wait for the bus before giving up."""
+ARBITER_TIMEOUT = 10.0
+"""Seconds without refresh after which a queue entry is dropped."""
+ARBITER_STALE = 2.0
+"""Seconds between checks of the queue, doubling up to ARBITER_POLL_MAX."""
+ARBITER_POLL = 0.002
+ARBITER_POLL_MAX = 0.05
+"""Seconds a read answer stays in the queue file for other processes."""
+ARBITER_RESULT_TTL = 5.0
+
+class BusBusyError(IOError):
+	"""The bus was not free within the timeout."""
+	pass
+
+def lock_file(f, blocking=True):
+	"""Lock an open file for this process, returns False if *blocking* is False and it is taken."""
+	if fcntl is not None:
+		try:
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return True
+		except (IOError, OSError):
+			if blocking:
+				raise
+			return False
+	while True:
+		f.seek(0)
+		try:
+			msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+			return True
+		except (IOError, OSError):
+			if not blocking:
+				return False
+			time.sleep(0.001)
+
+def open_file(path):
+	"""Open (or create, mode 0600) a file for reading and writing, never through a symbolic link."""
+	fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+	return os.fdopen(fd, 'r+')
+
+def unlock_file(f):
+	if fcntl is not None:
+		fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+	else:
+		f.seek(0)
+		msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class _Flight(object):
+	"""A read running in this process, identical reads wait for its answer."""
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class BusArbiter(object):
+	"""Serialize the operations of every thread and process on one port.
+
+	Args:
+		* portname (str): port name
+		* directory (str): where the queue files are, :func:`love8c_fast.private_dir` by default
+	"""
+
+	def __init__(self, portname, directory=None):
+		if directory is None:
+			directory = love8c_fast.private_dir()
+			if directory is None:
+				raise IOError('No private directory for the bus queue, check the love8c-<uid> directory of the temp directory')
+		base = os.path.join(directory, 'love8c-bus-' + re.sub(r'[^A-Za-z0-9]+', '_', portname))
+		self.queue_path = base + '.queue'
+		self.owner_path = base + '.owner'
+		self._cond = threading.Condition()
+		self._waiters = []
+		self._busy = False
+		self._flights = {}
+		self._counter = 0
+
+	def run(self, key, func, timeout=ARBITER_TIMEOUT):
+		"""Call func() when the bus is ours, returns its result.
+
+		*key* names a read (operation, address and registers) whose answer can be
+		shared with identical reads, None for writes. The answer must be JSON.
+		"""
+		deadline = time.time() + timeout
+		if key is None:
+			return self._run(None, func, time.time(), deadline)
+		with self._cond:
+			flight = self._flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self._flights[key] = _Flight()
+		if not leader:
+			if not flight.done.wait(max(0, deadline - time.time())):
+				raise BusBusyError('The bus is busy, waited {0:.1f} s'.format(timeout))
+			if flight.error is not None:
+				raise flight.error
+			return flight.result
+		try:
+			flight.result = self._run(key, func, time.time(), deadline)
+			return flight.result
+		except Exception as ex:
+			flight.error = ex
+			raise
+		finally:
+			with self._cond:
+				del self._flights[key]
+			flight.done.set()
+
+	def _run(self, key, func, requested, deadline):
+		token = object()
+		with self._cond:
+			self._waiters.append(token)
+			try:
+				while self._waiters[0] is not token or self._busy:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise BusBusyError('The bus is busy (other threads)')
+					self._cond.wait(remaining)
+				self._busy = True
+			finally:
+				self._waiters.remove(token)
+				self._cond.notify_all()
+		try:
+			return self._run_process(key, func, requested, deadline)
+		finally:
+			with self._cond:
+				self._busy = False
+				self._cond.notify_all()
+
+	def _update_queue(self, update):
+		"""Call update(state) with the queue file locked, state is saved after."""
+		with open_file(self.queue_path) as f:
+			lock_file(f)
+			try:
+				f.seek(0)
+				try:
+					state = json.loads(f.read() or '{}')
+				except ValueError:
+					state = {}
+				state.setdefault("queue", [])
+				state.setdefault("results", {})
+				now = time.time()
+				state["queue"] = [x for x in state["queue"] if now - x[1] < ARBITER_STALE]
+				for name in list(state["results"]):
+					if now - state["results"][name][0] > ARBITER_RESULT_TTL:
+						del state["results"][name]
+				result = update(state)
+				f.seek(0)
+				f.truncate()
+				f.write(json.dumps(state))
+				f.flush()
+				return result
+			finally:
+				unlock_file(f)
+
+	def _run_process(self, key, func, requested, deadline):
+		self._counter += 1
+		ticket = '{0}-{1}'.format(os.getpid(), self._counter)
+		owner = open_file(self.owner_path)
+		def enqueue(state):
+			state["queue"].append([ticket, time.time()])
+		def turn(state):
+			#A read of another process started after this request answers it too
+			if key is not None and key in state["results"] and state["results"][key][0] >= requested:
+				state["queue"] = [x for x in state["queue"] if x[0] != ticket]
+				return ("shared", state["results"][key][1])
+			entries = [x for x in state["queue"] if x[0] == ticket]
+			if not entries:
+				#Dropped as stale after a long pause, queue again
+				state["queue"].append([ticket, time.time()])
+			else:
+				entries[0][1] = time.time()
+			if state["queue"][0][0] == ticket and lock_file(owner, False):
+				state["queue"].pop(0)
+				return ("owner", None)
+			if time.time() >= deadline:
+				state["queue"] = [x for x in state["queue"] if x[0] != ticket]
+				return ("timeout", None)
+			return None
+		try:
+			self._update_queue(enqueue)
+			wait = ARBITER_POLL
+			while True:
+				outcome = self._update_queue(turn)
+				if outcome is not None:
+					break
+				time.sleep(wait)
+				wait = min(ARBITER_POLL_MAX, wait * 2)
+			if outcome[0] == "shared":
+				return outcome[1]
+			if outcome[0] == "timeout":
+				raise BusBusyError('The bus is busy (other processes)')
+			try:
+				started = time.time()
+				result = func()
+				if key is not None:
+					def share(state):
+						state["results"][key] = [started, result]
+					self._update_queue(share)
+				return result
+			finally:
+				unlock_file(owner)
+		finally:
+			owner.close()
+
+
+"""Arbiter of every port of the process, key: port name."""
+_arbiters = {}
+_arbiters_lock = threading.Lock()
+
+def bus_arbiter(portname):
+	with _arbiters_lock:
+		if portname not in _arbiters:
+			_arbiters[portname] = BusArbiter(portname)
+		return _arbiters[portname]
+
+def arbitrate(instr):
+	"""Make a :class:`love8c.Love8C` wait for its turn on the bus, returns it.
+
+	The port was already opened when *instr* was made: pass ``arbiter=bus_arbiter(portname)``
+	to :class:`love8c.Love8C` instead, so that is arbitrated too.
+	"""
+	instr.arbiter = bus_arbiter(instr.serial.port)
+	return instr
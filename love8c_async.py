@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+asyncio driver for the Love 8C process controller, Modbus ASCII only (the
+default protocol of the controller); use :class:`love8c.Love8C` for RTU.
+
+The serial port is opened non-blocking and read from the event loop with
+``loop.add_reader``, so a request never blocks the loop while waiting for the
+answer (POSIX only, the file descriptor of the port must be selectable)::
+
+	async def main():
+		instr = AsyncLove8C('/dev/ttyUSB0', 1)
+		pv = await instr.get_register('process_value')
+		await instr.set_register('set_point', 18.5)
+
+"""
+
+import asyncio
+import struct
+
+import serial
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Open buses, key: port name. Instruments on the same port share the bus, like in minimalmodbus.
+
+A bus follows the running event loop: a new loop (another ``asyncio.run``) takes
+it over, one loop at a time can use it.
+"""
+_buses = {}
+
+
+class AsyncBus(object):
+	"""A non-blocking serial port with one outstanding Modbus ASCII transaction at a time.
+
+	Args:
+		* portname (str): port name
+		* baudrate (int): baud rate
+		* framing (str): data bits, parity and stop bits, Example: '7E1'
+	"""
+
+	def __init__(self, portname, baudrate=9600, framing='7E1'):
+		bytesize, parity, stopbits = love8c.parse_framing(framing)
+		self.portname = portname
+		self.settings = (baudrate, framing.upper())
+		self.serial = serial.Serial()
+		self.serial.port = portname
+		self.serial.baudrate = baudrate
+		self.serial.bytesize = bytesize
+		self.serial.parity = parity
+		self.serial.stopbits = stopbits
+		self.serial.timeout = 0
+		self.lock = None
+		self._buffer = bytearray()
+		self._waiter = None
+		self._loop = None
+
+	def bind(self):
+		"""Attach the lock and the reader to the running event loop, if not already."""
+		loop = asyncio.get_event_loop()
+		if loop is self._loop:
+			return
+		if self.serial.is_open and self._loop is not None and not self._loop.is_closed():
+			self._loop.remove_reader(self.serial.fileno())
+		self._loop = loop
+		self.lock = asyncio.Lock()
+		if self.serial.is_open:
+			loop.add_reader(self.serial.fileno(), self._on_readable)
+
+	def open(self):
+		if self.serial.is_open:
+			return
+		self.serial.open()
+		self._loop.add_reader(self.serial.fileno(), self._on_readable)
+
+	def close(self):
+		if self.serial.is_open:
+			if self._loop is not None and not self._loop.is_closed():
+				self._loop.remove_reader(self.serial.fileno())
+			self.serial.close()
+
+	def _on_readable(self):
+		data = self.serial.read(self.serial.in_waiting or 1)
+		if self._waiter is None or self._waiter.done():
+			return
+		self._buffer.extend(data)
+		start = self._buffer.find(b':')
+		if start >= 0 and self._buffer.find(b'\r\n', start) >= 0:
+			self._waiter.set_result(None)
+
+	async def transaction(self, request, timeout):
+		"""Send a request frame and return the raw response frame."""
+		self.bind()
+		async with self.lock:
+			self.open()
+			self.serial.reset_input_buffer()
+			del self._buffer[:]
+			self._waiter = self._loop.create_future()
+			try:
+				self.serial.write(request)
+				try:
+					await asyncio.wait_for(self._waiter, timeout)
+				except asyncio.TimeoutError:
+					raise love8c.NoResponseError('No communication with the instrument (no answer)')
+				start = self._buffer.find(b':')
+				return bytes(self._buffer[start:self._buffer.find(b'\r\n', start) + 2])
+			finally:
+				self._waiter = None
+
+
+class AsyncLove8C(object):
+	"""asyncio counterpart of :class:`love8c.Love8C`, same register names and values.
+
+	Args:
+		* portname (str): port name
+		* slaveaddress (int): slave address in the range 1 to 247 (in decimal)
+		* timeout (float): seconds to wait for an answer
+		* baudrate (int): baud rate
+		* framing (str): data bits, parity and stop bits, Example: '7E1'
+
+	The instruments of a port share its bus, so they must use the same baud rate and framing.
+	"""
+
+	def __init__(self, portname, slaveaddress, timeout=0.5, baudrate=9600, framing='7E1'):
+		if portname not in _buses:
+			_buses[portname] = AsyncBus(portname, baudrate, framing)
+		self.bus = _buses[portname]
+		if self.bus.settings != (baudrate, framing.upper()):
+			raise ValueError('{0} is already used at {1} {2}'.format(portname, *self.bus.settings))
+		self.address = slaveaddress
+		self.timeout = timeout
+
+	async def read_registers(self, registeraddress, count):
+		request = love8c.ascii_frame(self.address, 3, bytearray(struct.pack('>HH', registeraddress, count)))
+		response = await self.bus.transaction(request, self.timeout)
+		payload = love8c.ascii_payload(response, self.address, 3)
+		if len(payload) != 1 + 2 * count or payload[0] != 2 * count:
+			raise love8c.InvalidResponseError('Wrong number of bytes in the response: {0!r}'.format(response))
+		return list(struct.unpack('>' + 'H' * count, bytes(payload[1:])))
+
+	async def write_register(self, registeraddress, raw):
+		payload = bytearray(struct.pack('>HH', registeraddress, raw))
+		response = await self.bus.transaction(love8c.ascii_frame(self.address, 6, payload), self.timeout)
+		if love8c.ascii_payload(response, self.address, 6) != payload:
+			raise love8c.InvalidResponseError('The slave did not echo the written register: {0!r}'.format(response))
+
+	async def get_register(self, name):
+		reg = love8c.REGISTERS[name]
+		raw = await self.read_registers(reg.address, 1)
+		return reg.decode(raw[0])
+
+	async def get_registers(self, names):
+		"""Read several registers with block reads, see :meth:`love8c.Love8C.get_registers`."""
+		values = {}
+		for layout in love8c.block_layouts(names):
+			layout.decode(await self.read_registers(layout.start, layout.count), values)
+		data = {}
+		for name in names:
+			data[name] = values[name]
+		return data
+
+	async def set_register(self, name, setpointvalue):
+		reg = love8c.REGISTERS[name]
+		if not reg.writable:
+			raise KeyError(name)
+		if (reg.check(setpointvalue) ):
+			await self.write_register(reg.address, reg.encode(setpointvalue))
+			return True
+		else:
+			return False
+
+	def close(self):
+		self.bus.close()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Throughput and latency benchmark for the Love 8C driver.
+
+Runs against emulated controllers on a pseudo-terminal (:mod:`love8c_emu`), or
+against a real port when ``-port`` is given, and writes the results as JSON so
+releases can be compared::
+
+	love8c_bench.py -rounds 20 -o bench.json
+	love8c_bench.py -port /dev/ttyUSB0 -address 1 -o bench_hw.json
+
+The write test writes the current set point back to the controller.
+
+``--startup`` times the command line instead, the way front ends run it (one
+process per request), with the imports of each command from ``-X importtime``::
+
+	love8c_bench.py --startup -rounds 20 -o startup.json
+
+"""
+
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Driver modes: (use get_registers block reads, keep the port open between calls, transport)."""
+MODES = {
+			'single': (False, False, 'minimalmodbus'),
+			'single_persistent': (False, True, 'minimalmodbus'),
+			'block': (True, False, 'minimalmodbus'),
+			'block_persistent': (True, True, 'minimalmodbus'),
+			'native_persistent': (False, True, 'native'),
+			'native_block_persistent': (True, True, 'native')
+}
+
+"""Command lines of the startup benchmark, none of them talks to a device."""
+STARTUP_COMMANDS = {
+			'emu_get': ['-e', '-get', 'all', '-port', 'COM99', '-address', '1', '-j'],
+			'emu_ports': ['-e', '-j'],
+			'ports': ['-j'],
+			'help': ['-h']
+}
+
+def percentile(samples, p):
+	"""Nearest-rank percentile of a list of numbers."""
+	ordered = sorted(samples)
+	if not ordered:
+		return None
+	index = int(round(p / 100.0 * (len(ordered) - 1)))
+	return ordered[index]
+
+def summarize(samples):
+	"""Latency statistics, in milliseconds, of a list of durations in seconds."""
+	if not samples:
+		return {"count": 0}
+	ms = [x * 1000.0 for x in samples]
+	return {
+		"count": len(ms),
+		"mean": sum(ms) / len(ms),
+		"min": min(ms),
+		"p50": percentile(ms, 50),
+		"p95": percentile(ms, 95),
+		"p99": percentile(ms, 99),
+		"max": max(ms)
+	}
+
+def make_instrument(portname, address, persistent, timeout=None, settings=None, transport='minimalmodbus'):
+	instr = love8c.Love8C(portname, address, transport=transport, **(settings or {}))
+	instr.close_port_after_each_call = not persistent
+	if timeout is not None:
+		instr.adaptive_timeout = False
+		instr.serial.timeout = timeout
+	return instr
+
+def timed(func, rounds):
+	"""Call func() *rounds* times, returns (durations, errors)."""
+	durations = []
+	errors = 0
+	for i in range(rounds):
+		start = time.time()
+		try:
+			func()
+		except Exception:
+			errors += 1
+			continue
+		durations.append(time.time() - start)
+	return durations, errors
+
+def bench_registers(instr, rounds):
+	"""Latency of get_register for every readable register."""
+	durations = []
+	errors = 0
+	per_register = {}
+	for name in love8c.REGISTER_READ_DETAIL:
+		samples, failed = timed(lambda: instr.get_register(name), rounds)
+		durations.extend(samples)
+		errors += failed
+		per_register[name] = summarize(samples)
+	total = sum(durations)
+	return {
+		"latency": summarize(durations),
+		"registers": per_register,
+		"errors": errors,
+		"transactions_per_second": len(durations) / total if total else None
+	}
+
+def bench_snapshot(instr, block, rounds):
+	"""Time of reading every readable register once."""
+	names = list(love8c.REGISTER_READ_DETAIL)
+	if block:
+		snapshot = lambda: instr.get_registers(names)
+		frames = len(love8c.plan_reads(names))
+	else:
+		snapshot = lambda: [instr.get_register(x) for x in names]
+		frames = len(names)
+	samples, errors = timed(snapshot, rounds)
+	total = sum(samples)
+	return {
+		"time": summarize(samples),
+		"frames": frames,
+		"errors": errors,
+		"transactions_per_second": frames * len(samples) / total if total else None
+	}
+
+def bench_write_readback(instr, rounds, name='set_point'):
+	"""Time of writing the current value of *name* and reading it back."""
+	value = instr.get_register(name)
+	def write_readback():
+		instr.set_register(name, value)
+		if instr.get_register(name) != value:
+			raise ValueError('Read back a different value')
+	samples, errors = timed(write_readback, rounds)
+	return {"time": summarize(samples), "errors": errors}
+
+def parse_importtime(text):
+	"""Top level imports of ``-X importtime`` output: (modules imported, dict name -> cumulative seconds)."""
+	count = 0
+	imports = {}
+	for line in text.splitlines():
+		if not line.startswith('import time:') or line.endswith('| imported package'):
+			continue
+		fields = line[len('import time:'):].split('|')
+		count += 1
+		if not fields[2].startswith('  '):
+			imports[fields[2].strip()] = int(fields[1]) / 1000000.0
+	return count, imports
+
+def bench_startup(rounds, commands=None, script=None):
+	"""Wall time of ``love8c.py`` commands, one new interpreter per call, and the imports they load."""
+	if script is None:
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'love8c.py')
+	if commands is None:
+		commands = STARTUP_COMMANDS
+	results = {}
+	for name, argv in sorted(commands.items()):
+		samples = []
+		for i in range(rounds):
+			start = time.time()
+			proc = subprocess.Popen([sys.executable, '-X', 'importtime', script] + argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			stderr = proc.communicate()[1]
+			samples.append(time.time() - start)
+		count, imports = parse_importtime(stderr.decode('utf-8', 'replace'))
+		slowest = sorted(imports, key=imports.get, reverse=True)[:5]
+		results[name] = {
+			"argv": argv,
+			"time": summarize(samples),
+			"modules": count,
+			"slowest_imports": dict((x, imports[x] * 1000.0) for x in slowest)
+		}
+	return results
+
+def run(portname, address, rounds=10, modes=None, timeout=None, settings=None):
+	"""Run every benchmark on one controller and return the results dict.
+
+	*settings* are passed to :class:`love8c.Love8C` (mode, baudrate, framing).
+	"""
+	results = {
+		"time": time.time(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"minimalmodbus": getattr(love8c.minimalmodbus, '__version__', None),
+		"port": portname,
+		"address": address,
+		"rounds": rounds,
+		"settings": settings or {},
+		"modes": {}
+	}
+	if modes is None:
+		modes = sorted(MODES)
+		if (settings or {}).get("mode", "ascii") != "ascii":
+			modes = [x for x in modes if MODES[x][2] != 'native']
+	for mode in modes:
+		block, persistent, transport = MODES[mode]
+		instr = make_instrument(portname, address, persistent, timeout, settings, transport)
+		data = {}
+		data["snapshot"] = bench_snapshot(instr, block, rounds)
+		if not block:
+			data["get_register"] = bench_registers(instr, rounds)
+		data["write_readback"] = bench_write_readback(instr, rounds)
+		instr.serial.close()
+		results["modes"][mode] = data
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Love 8C driver benchmark.')
+	parser.add_argument('-port', metavar='port', nargs=1, help='Real port, emulated controllers when not given, Example: COM3')
+	parser.add_argument('-address', metavar='deviceNro', nargs=1, type=int, default=[1], help='Device address for RS485, Example: 1')
+	parser.add_argument('-rounds', metavar='n', nargs=1, type=int, default=[10], help='Repetitions of each measure, Example: 20')
+	parser.add_argument('-modes', metavar='list', nargs=1, help='Modes to run, Example: single,block_persistent')
+	parser.add_argument('-latency', metavar='seconds', nargs=1, type=float, default=[0.0], help='Emulated response latency, Example: 0.02')
+	parser.add_argument('-timeout', metavar='seconds', nargs=1, type=float, help='Serial timeout, Example: 0.5')
+	parser.add_argument('-mode', metavar='mode', nargs=1, choices=['ascii', 'rtu'], default=['ascii'], help='Modbus protocol: ascii (default) or rtu')
+	parser.add_argument('-baudrate', metavar='baud', nargs=1, type=int, default=[9600], help='Baud rate, Example: 38400')
+	parser.add_argument('-framing', metavar='framing', nargs=1, help='Data bits, parity and stop bits, Example: 8N1')
+	parser.add_argument("--startup", action="count", default=0, help='Time the command line startup instead of the driver')
+	parser.add_argument('-o', metavar='file', nargs=1, help='Write the JSON results to a file')
+	args = parser.parse_args()
+
+	settings = {"mode": args.mode[0], "baudrate": args.baudrate[0]}
+	if args.framing:
+		settings["framing"] = args.framing[0]
+
+	modes = None
+	if args.modes:
+		modes = [x.strip() for x in args.modes[0].split(",")]
+	timeout = args.timeout[0] if args.timeout else None
+	bus = None
+	if args.startup:
+		results = {
+			"time": time.time(),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"rounds": args.rounds[0],
+			"startup": bench_startup(args.rounds[0])
+		}
+	else:
+		if args.port:
+			portname = args.port[0]
+		else:
+			import love8c_emu
+			bus = love8c_emu.EmulatedBus([args.address[0]], latency=args.latency[0], mode=args.mode[0])
+			portname = bus.start()
+		try:
+			results = run(portname, args.address[0], args.rounds[0], modes, timeout, settings)
+		finally:
+			if bus:
+				bus.stop()
+	if bus:
+		results["emulated"] = {"latency": args.latency[0]}
+	json_data = json.dumps(results, indent=1, sort_keys=True)
+	if args.o:
+		with open(args.o[0], 'w') as f:
+			f.write(json_data)
+	sys.stdout.write(json_data + '\n')
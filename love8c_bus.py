@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Polling of many Love 8C controllers sharing one RS485 bus.
+
+"""
+
+import time
+import threading
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Poll classes, lower priority value is served first when the bus is saturated."""
+POLL_CLASSES = {
+			'fast': 0,
+			'setting': 1,
+			'config': 2
+}
+
+"""Default poll period (seconds) of each class, None is read only on demand."""
+POLL_RATES = {
+			'fast': 0.5,
+			'setting': 10.0,
+			'config': 300.0
+}
+
+"""Values that change on their own are 'fast', values set from the panel are 'setting'."""
+REGISTER_POLL_CLASS = {
+			'process_value': 'fast',
+			'status': 'fast',
+			'leds': 'fast',
+			'output': 'fast',
+			'control_output': 'fast',
+			'set_point': 'setting',
+			'control_run_stop_setting': 'setting',
+			'at_setting': 'setting',
+			'lock_status': 'setting'
+}
+
+def poll_class(name):
+	return REGISTER_POLL_CLASS.get(name, 'config')
+
+"""Seconds an on demand read (no period) may wait behind the other classes."""
+ON_DEMAND_MAX_WAIT = 1.0
+
+"""Scan timeouts (seconds): first probe, bounds, and multiple of the slowest answer seen."""
+SCAN_TIMEOUT = 0.15
+SCAN_TIMEOUT_MIN = 0.05
+SCAN_TIMEOUT_MAX = 0.5
+SCAN_TIMEOUT_FACTOR = 3
+
+def parse_addresses(text):
+	"""Parse a slave address list like '1,2,5-8'."""
+	addresses = []
+	for part in text.split(","):
+		part = part.strip()
+		if not part:
+			continue
+		if "-" in part:
+			first, last = part.split("-", 1)
+			addresses.extend(range(int(first), int(last) + 1))
+		else:
+			addresses.append(int(part))
+	return addresses
+
+
+def parse_buses(specs):
+	"""Parse bus specs like ['COM3:1-4', '/dev/ttyUSB1:1,7'] into a dict port -> addresses."""
+	buses = {}
+	for spec in specs:
+		portname, addresses = spec.rsplit(":", 1)
+		buses.setdefault(portname, []).extend(parse_addresses(addresses))
+	return buses
+
+
+def scan_bus(portname, addresses=None, timeout=SCAN_TIMEOUT, instrument_factory=None):
+	"""Probe the slave addresses of one port (1 to 247 by default) with a software_version read.
+
+	The timeout starts at *timeout* and then follows the slowest answer seen on the
+	bus (:data:`SCAN_TIMEOUT_FACTOR` times, within :data:`SCAN_TIMEOUT_MIN` and
+	:data:`SCAN_TIMEOUT_MAX`), so empty addresses cost little.
+
+	Yields a dict with address, software_version, input_temperature_sensor_type,
+	sensor (its label) and time (seconds of the probe) for every controller found.
+	"""
+	if addresses is None:
+		addresses = range(1, 248)
+	if instrument_factory is None:
+		instrument_factory = love8c.Love8C
+	addresses = list(addresses)
+	if not addresses:
+		return
+	instr = instrument_factory(portname, addresses[0])
+	instr.close_port_after_each_call = False
+	instr.adaptive_timeout = False
+	instr.circuit_breaker = False
+	saved_timeout = instr.serial.timeout
+	slowest = 0
+	try:
+		for address in addresses:
+			instr.address = address
+			instr.serial.timeout = timeout
+			start = time.time()
+			try:
+				version = instr.get_register('software_version')
+			except (IOError, ValueError):
+				continue
+			elapsed = time.time() - start
+			slowest = max(slowest, elapsed)
+			timeout = min(SCAN_TIMEOUT_MAX, max(SCAN_TIMEOUT_MIN, SCAN_TIMEOUT_FACTOR * slowest))
+			device = {"address": address, "software_version": version, "time": elapsed}
+			instr.serial.timeout = SCAN_TIMEOUT_MAX
+			try:
+				sensor = instr.get_register('input_temperature_sensor_type')
+				device["input_temperature_sensor_type"] = sensor
+				device["sensor"] = love8c.SENSOR_TYPES.get(sensor)
+			except (IOError, ValueError):
+				pass
+			yield device
+	finally:
+		instr.serial.timeout = saved_timeout
+
+
+class PollTask(object):
+
+	def __init__(self, address, cls, names, period):
+		self.address = address
+		self.cls = cls
+		self.names = names
+		self.period = period
+		self.due = time.time() if period is not None else None
+
+
+class BusScheduler(object):
+	"""Round-robin poller for the slaves of one serial port.
+
+	Every slave gets one task per poll class; each task reads its registers with
+	:meth:`love8c.Love8C.get_registers` when it is due. When several tasks are due
+	the one with the best class priority, then the oldest due time, goes first, so a
+	saturated bus keeps refreshing the 'fast' registers of every slave in turn. A
+	task overdue by more than its period (:data:`ON_DEMAND_MAX_WAIT` for on demand
+	reads) goes before any class, so the other classes are late but never starved.
+
+	Args:
+		* portname (str): port name
+		* addresses (list): slave addresses on the bus
+		* names (list): registers to poll, all readable registers by default
+		* rates (dict): poll class -> period in seconds (None for on demand), overrides :data:`POLL_RATES`
+		* callback: called as callback(address, data, timestamp) after every read,
+		  data is a dict name -> value or a :func:`love8c.error_data` dict
+		* instrument_factory: called as instrument_factory(portname, address), :class:`love8c.Love8C` by default
+	"""
+
+	def __init__(self, portname, addresses, names=None, rates=None, callback=None, instrument_factory=None):
+		self.portname = portname
+		self.addresses = list(addresses)
+		self.callback = callback
+		self.rates = dict(POLL_RATES)
+		if rates:
+			self.rates.update(rates)
+		if names is None:
+			names = list(love8c.REGISTER_READ_DETAIL)
+		if instrument_factory is None:
+			instrument_factory = love8c.Love8C
+		self.instruments = {}
+		self.latest = {}
+		self.tasks = []
+		for address in self.addresses:
+			instr = instrument_factory(portname, address)
+			instr.close_port_after_each_call = False
+			self.instruments[address] = instr
+			self.latest[address] = {}
+			for cls in sorted(POLL_CLASSES, key=POLL_CLASSES.get):
+				cls_names = [x for x in names if poll_class(x) == cls]
+				if cls_names:
+					self.tasks.append(PollTask(address, cls, cls_names, self.rates[cls]))
+
+	def refresh(self, address=None, cls=None):
+		"""Make the tasks of a slave and/or class due now, for on demand reads."""
+		now = time.time()
+		for task in self.tasks:
+			if (address is None or task.address == address) and (cls is None or task.cls == cls):
+				task.due = now
+
+	def next_task(self, now):
+		"""Return the task to run now, or the time to wait (seconds) when none is due."""
+		due = [x for x in self.tasks if x.due is not None and x.due <= now]
+		if due:
+			starved = [x for x in due if now - x.due > (x.period if x.period is not None else ON_DEMAND_MAX_WAIT)]
+			if starved:
+				return min(starved, key=lambda x: x.due)
+			return min(due, key=lambda x: (POLL_CLASSES[x.cls], x.due))
+		pending = [x.due for x in self.tasks if x.due is not None]
+		if not pending:
+			return None
+		return min(pending) - now
+
+	def run_task(self, task):
+		now = time.time()
+		try:
+			data = self.instruments[task.address].get_registers(task.names)
+			self.latest[task.address].update(data)
+		except Exception as ex:
+			data = love8c.error_data(ex)
+		if task.period is None:
+			task.due = None
+		else:
+			task.due = max(task.due + task.period, now)
+		if self.callback:
+			self.callback(task.address, data, now)
+		return data
+
+	def run_once(self):
+		"""Run at most one due task. Returns seconds to wait before the next one (None if idle)."""
+		task = self.next_task(time.time())
+		if isinstance(task, PollTask):
+			self.run_task(task)
+			return 0
+		return task
+
+	def run(self, stop_event=None, idle_wait=0.5):
+		"""Poll until *stop_event* (a threading.Event) is set."""
+		while stop_event is None or not stop_event.is_set():
+			wait = self.run_once()
+			if wait is None:
+				wait = idle_wait
+			if wait > 0:
+				if stop_event is None:
+					time.sleep(wait)
+				else:
+					stop_event.wait(wait)
+
+	def close(self):
+		for instr in self.instruments.values():
+			instr.serial.close()
+
+
+class Fleet(object):
+	"""Several independent buses polled concurrently, one worker thread per port.
+
+	Each bus is still serialized inside its own worker, so the time of a full
+	snapshot is set by the slowest bus instead of the sum of all of them.
+
+	Args:
+		* buses (dict): port name -> list of slave addresses
+		* instrument_factory: called as instrument_factory(portname, address), :class:`love8c.Love8C` by default
+	"""
+
+	def __init__(self, buses, instrument_factory=None):
+		self.buses = buses
+		self.instrument_factory = instrument_factory
+		if self.instrument_factory is None:
+			self.instrument_factory = love8c.Love8C
+
+	def snapshot(self, names=None):
+		"""Read *names* (all readable registers by default) once from every slave.
+
+		Yields (portname, address, data) as soon as each device answers, data is a
+		dict name -> value or a :func:`love8c.error_data` dict.
+		"""
+		if names is None:
+			names = list(love8c.REGISTER_READ_DETAIL)
+		return self.each(lambda instr: instr.get_registers(names))
+
+	def each(self, func):
+		"""Call func(instrument) once for every slave, the buses in parallel.
+
+		Yields (portname, address, result) as soon as each call returns, a failed call
+		gives a :func:`love8c.error_data` dict as result.
+		"""
+		def worker(portname, addresses, put):
+			for address in addresses:
+				instr = None
+				try:
+					instr = self.instrument_factory(portname, address)
+					instr.close_port_after_each_call = False
+					data = func(instr)
+				except Exception as ex:
+					data = love8c.error_data(ex)
+				finally:
+					if instr is not None:
+						instr.serial.close()
+				put((portname, address, data))
+		return self.run_buses(worker)
+
+	def scan(self, timeout=SCAN_TIMEOUT):
+		"""Find the controllers of every bus with :func:`scan_bus`, the buses in parallel.
+
+		The addresses of each bus are the candidates to probe. Yields (portname,
+		device) for every controller found, or (portname, error_data) when a port fails.
+		"""
+		def worker(portname, addresses, put):
+			try:
+				for device in scan_bus(portname, addresses, timeout, self.instrument_factory):
+					put((portname, device))
+			except Exception as ex:
+				put((portname, love8c.error_data(ex)))
+		return self.run_buses(worker)
+
+	def broadcast(self, name, value, verify=True):
+		"""Write *name* on every bus with :meth:`love8c.Love8C.broadcast_register`, the buses in parallel.
+
+		With *verify* the register is then read back from every slave, yields
+		(portname, address, result) as soon as each answers, result is a dict with
+		name, value, read and verified (or a :func:`love8c.error_data` dict).
+		Without, yields (portname, None, result) per bus once the frame is sent.
+		"""
+		expected = love8c.readback_value(name, value)
+		def worker(portname, addresses, put):
+			instr = None
+			try:
+				instr = self.instrument_factory(portname, addresses[0])
+				instr.close_port_after_each_call = False
+				sent = instr.broadcast_register(name, value)
+				if not (sent and verify):
+					put((portname, None, {"name": name, "value": value, "sent": sent}))
+					return
+				for address in addresses:
+					try:
+						instr.address = address
+						read = instr.get_register(name)
+						data = {"name": name, "value": value, "read": read, "verified": read == expected}
+					except Exception as ex:
+						data = love8c.error_data(ex)
+					put((portname, address, data))
+			except Exception as ex:
+				put((portname, None, love8c.error_data(ex)))
+			finally:
+				if instr is not None:
+					instr.serial.close()
+		return self.run_buses(worker)
+
+	def run_buses(self, worker):
+		"""Run worker(portname, addresses, put) in one thread per bus, yields what the workers put."""
+		results = queue.Queue()
+		def run(portname, addresses):
+			try:
+				worker(portname, addresses, results.put)
+			finally:
+				results.put(None)
+		workers = []
+		for portname, addresses in self.buses.items():
+			thread = threading.Thread(target=run, args=(portname, addresses))
+			thread.daemon = True
+			thread.start()
+			workers.append(thread)
+		running = len(workers)
+		while running:
+			item = results.get()
+			if item is None:
+				running -= 1
+			else:
+				yield item
+
+	def poll(self, callback, names=None, rates=None, stop_event=None):
+		"""Run one :class:`BusScheduler` per port until *stop_event* is set.
+
+		*callback* is called as callback(portname, address, data, timestamp), never
+		from two workers at the same time. A port that can not be opened gives one
+		:func:`love8c.error_data` dict per address and is not polled.
+		"""
+		if stop_event is None:
+			stop_event = threading.Event()
+		lock = threading.Lock()
+		def bus_callback(portname):
+			def on_data(address, data, timestamp):
+				with lock:
+					callback(portname, address, data, timestamp)
+			return on_data
+		schedulers = []
+		for portname, addresses in self.buses.items():
+			on_data = bus_callback(portname)
+			try:
+				schedulers.append(BusScheduler(portname, addresses, names, rates, on_data, self.instrument_factory))
+			except Exception as ex:
+				data = love8c.error_data(ex)
+				for address in addresses:
+					on_data(address, data, time.time())
+		workers = []
+		for scheduler in schedulers:
+			thread = threading.Thread(target=scheduler.run, args=(stop_event,))
+			thread.daemon = True
+			thread.start()
+			workers.append(thread)
+		try:
+			while any(x.is_alive() for x in workers):
+				for thread in workers:
+					thread.join(0.5)
+		finally:
+			stop_event.set()
+			for scheduler in schedulers:
+				scheduler.close()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Emulated Love 8C slaves on a Linux pseudo-terminal, for benchmarks and tests
+without hardware.
+
+Answers Modbus ASCII function codes 3 and 6 over the ``REGISTER_START`` map for
+several slave addresses on one virtual bus, with configurable latency and
+injected faults. The process value follows the set point while running::
+
+	love8c_emu.py -addresses 1-3 -latency 0.01 -link /tmp/ttyLOVE
+	love8c.py -get all -port /tmp/ttyLOVE -address 2 -j
+
+"""
+
+import os
+import sys
+import tty
+import time
+import random
+import struct
+import argparse
+import threading
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Register values of a new emulated controller (same as the -e output of love8c.py)."""
+EMU_VALUES = {
+			'process_value': 17.4,
+			'set_point': 18.5,
+			'upper_limit_alarm_1': 2.0,
+			'lower_limit_alarm_1': 2.0,
+			'upper_limit_alarm_2': 3.0,
+			'lower_limit_alarm_2': 3.0,
+			'upper_limit_of_temperature_range': 500.0,
+			'lower_limit_of_temperature_range': -20.0,
+			'pb_proportional_band': 2.0,
+			'ti_integral_time': 10,
+			'td_derivative_time': 41,
+			'heating_cooling_hysteresis': 0.1,
+			'input_temperature_sensor_type': 14,
+			'control_method': 1,
+			'heating_cooling_control_cycle': 22,
+			'proportional_control_offset_error_value': 0,
+			'temperature_regulation_value': 0.0,
+			'alarm_1_type': 1,
+			'alarm_2_type': 1,
+			'temperature_unit_display_selection': 1,
+			'heating_cooling_control_selection': 0,
+			'control_run_stop_setting': 1,
+			'communication_write_in_selection': 1,
+			'software_version': 1056,
+			'at_setting': 0,
+			'status': 0,
+			'lock_status': 0,
+			'i_offset': 0,
+			'output': 0,
+			'control_output': 0,
+			'leds': 8
+}
+
+#Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+SLAVE_DEVICE_FAILURE = 4
+
+#Readable address range, unmapped registers inside it read as 0
+ADDRESS_FIRST = min(love8c.REGISTER_START.values())
+ADDRESS_LAST = max(love8c.REGISTER_START.values())
+
+NAMES_BY_ADDRESS = dict((v, k) for k, v in love8c.REGISTER_START.items())
+
+#LEDS bits (see the reverse engineering notes in love8c.py)
+LED_F = 4
+LED_C = 8
+LED_ALARM2 = 16
+LED_ALARM1 = 32
+LED_OUTPUT = 64
+LED_AT = 128
+
+
+class EmulatedLove8C(object):
+	"""Register file and thermal model of one emulated controller.
+
+	Args:
+		* ambient (float): temperature the process drifts to when stopped
+		* heat_rate (float): degrees per second at 100% output
+		* loss (float): fraction of the difference to ambient lost per second
+		* noise (float): amplitude of the random noise added to the process value
+	"""
+
+	def __init__(self, values=None, ambient=17.0, heat_rate=1.0, loss=0.01, noise=0.05):
+		self.values = dict(EMU_VALUES)
+		if values:
+			self.values.update(values)
+		self.ambient = ambient
+		self.heat_rate = heat_rate
+		self.loss = loss
+		self.noise = noise
+		self.pv = float(self.values['process_value'])
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def update(self, now=None):
+		"""Advance the process value to *now*."""
+		if now is None:
+			now = time.time()
+		dt = max(0.0, now - self.updated)
+		self.updated = now
+		output = 0.0
+		if self.values['control_run_stop_setting']:
+			error = self.values['set_point'] - self.pv
+			if self.values['control_method'] == 1:
+				output = 100.0 if error > self.values['heating_cooling_hysteresis'] else 0.0
+			elif self.values['control_method'] == 2:
+				output = float(self.values['output'])
+			else:
+				output = min(100.0, max(0.0, 100.0 * error / max(self.values['pb_proportional_band'], 0.1)))
+			if self.values['heating_cooling_control_selection'] == 1:
+				output = 100.0 - output
+		self.pv += dt * (self.heat_rate * output / 100.0 - self.loss * (self.pv - self.ambient))
+		self.values['process_value'] = round(self.pv + random.uniform(-self.noise, self.noise) + self.values['temperature_regulation_value'], 1)
+		self.values['control_output'] = int(round(output))
+		if self.values['control_method'] != 2:
+			self.values['output'] = int(round(output))
+		leds = LED_C if self.values['temperature_unit_display_selection'] == 1 else LED_F
+		if output > 0:
+			leds |= LED_OUTPUT
+		if self.values['at_setting']:
+			leds |= LED_AT
+		if self.alarm(1):
+			leds |= LED_ALARM1
+		if self.alarm(2):
+			leds |= LED_ALARM2
+		self.values['leds'] = leds
+
+	def alarm(self, number):
+		"""State of an alarm output, for the deviation and absolute value types."""
+		kind = self.values['alarm_{0}_type'.format(number)]
+		upper = self.values['upper_limit_alarm_{0}'.format(number)]
+		lower = self.values['lower_limit_alarm_{0}'.format(number)]
+		pv = self.values['process_value']
+		sp = self.values['set_point']
+		if kind in (1, 8):
+			return pv > sp + upper or pv < sp - lower
+		if kind in (2, 9):
+			return pv > sp + upper
+		if kind in (3, 10):
+			return pv < sp - lower
+		if kind == 5:
+			return pv > upper or pv < lower
+		if kind == 6:
+			return pv > upper
+		if kind == 7:
+			return pv < lower
+		return False
+
+	def read(self, start, count):
+		"""Raw words of a block read, or a Modbus exception code."""
+		if start < ADDRESS_FIRST or start + count - 1 > ADDRESS_LAST:
+			return ILLEGAL_DATA_ADDRESS
+		with self.lock:
+			self.update()
+			words = []
+			for address in range(start, start + count):
+				name = NAMES_BY_ADDRESS.get(address)
+				if name is None:
+					words.append(0)
+				elif name == 'lock_status':
+					words.append(self.lock_status_read())
+				else:
+					words.append(self.raw(name))
+			return words
+
+	def raw(self, name):
+		value = int(round(self.values[name] * 10 ** love8c.REGISTER_READ_DETAIL[name][0]))
+		return value & 0xFFFF
+
+	def lock_status_read(self):
+		label = love8c.LOCK_STATUS_SET.get(self.values['lock_status'])
+		for key, value in love8c.LOCK_STATUS_READ.items():
+			if value == label:
+				return key
+		return 0
+
+	def write(self, address, raw):
+		"""Write one raw word, returns None or a Modbus exception code."""
+		name = NAMES_BY_ADDRESS.get(address)
+		if name not in love8c.REGISTER_WRITE_DETAIL:
+			return ILLEGAL_DATA_ADDRESS
+		detail = love8c.REGISTER_WRITE_DETAIL[name]
+		if detail[3] == 1 and raw >= 0x8000:
+			raw = raw - 0x10000
+		value = raw / float(10 ** detail[1]) if detail[1] else raw
+		if not love8c.checkNumerical(value, minvalue=detail[4], maxvalue=detail[5]):
+			return ILLEGAL_DATA_VALUE
+		if name == 'lock_status' and value not in love8c.LOCK_STATUS_SET:
+			return ILLEGAL_DATA_VALUE
+		with self.lock:
+			self.update()
+			self.values[name] = value
+		return None
+
+
+class EmulatedBus(object):
+	"""Several emulated controllers answering on one pseudo-terminal.
+
+	Args:
+		* addresses (list): slave addresses on the bus
+		* latency (float): seconds between a request and its answer
+		* timeout_rate (float): probability of not answering a request
+		* bad_lrc_rate (float): probability of answering with a wrong LRC (CRC in RTU mode)
+		* exception_rate (float): probability of answering with exception code 4
+		* link (str): optional symlink to create to the slave side of the pty
+		* mode (str): 'ascii' or 'rtu'
+	"""
+
+	def __init__(self, addresses, latency=0.0, timeout_rate=0.0, bad_lrc_rate=0.0, exception_rate=0.0, link=None, max_registers=125, mode='ascii'):
+		self.slaves = {}
+		for address in addresses:
+			self.slaves[address] = EmulatedLove8C()
+		self.latency = latency
+		self.timeout_rate = timeout_rate
+		self.bad_lrc_rate = bad_lrc_rate
+		self.exception_rate = exception_rate
+		self.link = link
+		self.max_registers = max_registers
+		self.mode = mode
+		self.requests = 0
+		self.master = None
+		self.slave = None
+		self.portname = None
+		self._thread = None
+		self._stop = threading.Event()
+
+	def start(self):
+		"""Open the pty and answer in a background thread. Returns the port name for the clients."""
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.master)
+		tty.setraw(self.slave)
+		self.portname = os.ttyname(self.slave)
+		if self.link:
+			if os.path.lexists(self.link):
+				os.remove(self.link)
+			os.symlink(self.portname, self.link)
+		self._stop.clear()
+		self._thread = threading.Thread(target=self.run)
+		self._thread.daemon = True
+		self._thread.start()
+		return self.link or self.portname
+
+	def stop(self):
+		self._stop.set()
+		if self._thread:
+			self._thread.join(1.0)
+		if self.link and os.path.islink(self.link):
+			os.remove(self.link)
+		for fd in (self.master, self.slave):
+			if fd is not None:
+				os.close(fd)
+		self.master = self.slave = None
+
+	def run(self):
+		import select
+		buffer = bytearray()
+		while not self._stop.is_set():
+			readable = select.select([self.master], [], [], 0.1)[0]
+			if not readable:
+				continue
+			try:
+				buffer.extend(os.read(self.master, 1024))
+			except OSError:
+				break
+			if self.mode == 'rtu':
+				requests = self.split_rtu(buffer)
+			else:
+				requests = self.split_ascii(buffer)
+			for body in requests:
+				response = self.handle(body)
+				if response is not None:
+					if self.latency:
+						time.sleep(self.latency)
+					os.write(self.master, response)
+
+	def split_ascii(self, buffer):
+		"""Take the complete ':...\\r\\n' frames out of *buffer*, returns their bodies with a valid LRC."""
+		bodies = []
+		while True:
+			start = buffer.find(b':')
+			if start < 0:
+				del buffer[:]
+				break
+			end = buffer.find(b'\r\n', start)
+			if end < 0:
+				del buffer[:start]
+				break
+			frame = bytes(buffer[start + 1:end])
+			del buffer[:end + 2]
+			try:
+				body = bytearray.fromhex(frame.decode('ascii'))
+			except ValueError:
+				continue
+			if len(body) >= 3 and love8c.lrc(body[:-1]) == body[-1]:
+				bodies.append(body[:-1])
+		return bodies
+
+	def split_rtu(self, buffer):
+		"""Take the 8 byte function 3/6 requests out of *buffer*, returns their bodies with a valid CRC."""
+		bodies = []
+		while len(buffer) >= 8:
+			body = bytearray(buffer[:6])
+			if love8c.crc16(body) == buffer[6] | (buffer[7] << 8):
+				bodies.append(body)
+				del buffer[:8]
+			else:
+				del buffer[:1]
+		return bodies
+
+	def handle(self, body):
+		"""Answer a request (address, function code and payload, without LRC/CRC), None when nothing must be sent."""
+		self.requests += 1
+		address, functioncode, payload = body[0], body[1], body[2:]
+		if address == love8c.BROADCAST_ADDRESS:
+			#Every slave applies a broadcast write, none answers
+			if functioncode == 6 and len(payload) == 4:
+				first, second = struct.unpack('>HH', bytes(payload))
+				for slave in self.slaves.values():
+					slave.write(first, second)
+			return None
+		if address not in self.slaves:
+			return None
+		if self.timeout_rate and random.random() < self.timeout_rate:
+			return None
+		if self.exception_rate and random.random() < self.exception_rate:
+			return self.frame(address, functioncode | 0x80, bytearray([SLAVE_DEVICE_FAILURE]))
+		slave = self.slaves[address]
+		if len(payload) != 4:
+			return self.frame(address, functioncode | 0x80, bytearray([ILLEGAL_DATA_VALUE]))
+		first, second = struct.unpack('>HH', bytes(payload))
+		if functioncode == 3:
+			if not 1 <= second <= self.max_registers:
+				return self.frame(address, 0x83, bytearray([ILLEGAL_DATA_VALUE]))
+			words = slave.read(first, second)
+			if not isinstance(words, list):
+				return self.frame(address, 0x83, bytearray([words]))
+			return self.frame(address, 3, bytearray([2 * second]) + bytearray(struct.pack('>' + 'H' * second, *words)))
+		if functioncode == 6:
+			error = slave.write(first, second)
+			if error is not None:
+				return self.frame(address, 0x86, bytearray([error]))
+			return self.frame(address, 6, payload)
+		return self.frame(address, functioncode | 0x80, bytearray([ILLEGAL_FUNCTION]))
+
+	def frame(self, address, functioncode, payload):
+		if self.mode == 'rtu':
+			response = love8c.rtu_frame(address, functioncode, payload)
+			if self.bad_lrc_rate and random.random() < self.bad_lrc_rate:
+				response = response[:-2] + bytes(bytearray([response[-2] ^ 0xFF, response[-1]]))
+			return response
+		response = love8c.ascii_frame(address, functioncode, payload)
+		if self.bad_lrc_rate and random.random() < self.bad_lrc_rate:
+			response = response[:-4] + (b'00' if response[-4:-2] != b'00' else b'FF') + b'\r\n'
+		return response
+
+
+if __name__ == '__main__':
+	import love8c_bus
+
+	parser = argparse.ArgumentParser(description='Love 8C emulated slaves on a pseudo-terminal.')
+	parser.add_argument('-addresses', metavar='list', nargs=1, default=['1'], help='Slave addresses, Example: 1,2,5-8')
+	parser.add_argument('-latency', metavar='seconds', nargs=1, type=float, default=[0.0], help='Response latency, Example: 0.02')
+	parser.add_argument('-timeout_rate', metavar='p', nargs=1, type=float, default=[0.0], help='Probability of not answering, Example: 0.01')
+	parser.add_argument('-bad_lrc_rate', metavar='p', nargs=1, type=float, default=[0.0], help='Probability of a wrong LRC')
+	parser.add_argument('-exception_rate', metavar='p', nargs=1, type=float, default=[0.0], help='Probability of an exception response')
+	parser.add_argument('-link', metavar='path', nargs=1, help='Symlink to the port, Example: /tmp/ttyLOVE')
+	parser.add_argument('-mode', metavar='mode', nargs=1, choices=['ascii', 'rtu'], default=['ascii'], help='Modbus protocol: ascii (default) or rtu')
+	args = parser.parse_args()
+
+	bus = EmulatedBus(love8c_bus.parse_addresses(args.addresses[0]), args.latency[0], args.timeout_rate[0], args.bad_lrc_rate[0], args.exception_rate[0], args.link[0] if args.link else None, mode=args.mode[0])
+	sys.stdout.write(bus.start() + '\n')
+	sys.stdout.flush()
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		bus.stop()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Fast path of the ``love8c.py`` command line.
+
+Front ends start the script once per request, so the commands that never talk
+to a device are answered here before minimalmodbus, pyserial and argparse are
+imported: the emulated answers (``-e``) and the port listing while the ports
+cache is fresh. Anything else, or any argument not understood here, goes on to
+the full command line.
+
+"""
+
+import os
+import sys
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Port listings younger than this (seconds) are answered from the cache."""
+PORTS_CACHE_SECONDS = 10
+PORTS_CACHE_NAME = 'love8c_ports.json'
+PRIVATE_DIR_PREFIX = 'love8c-'
+
+"""Emulated answers of -get all, key: address (EMU_ANSWER for the rest)."""
+EMU_ANSWER = '{"i_offset":0,"output":0, "control_output": 0,"process_value": 17.4, "upper_limit_alarm_1": 2.0, "temperature_unit_display_selection": 1, "at_setting": 0, "heating_cooling_hysteresis": 0.1, "alarm_2_type": 1, "temperature_regulation_value": 0.0, "ti_integral_time": 10, "alarm_1_type": 1, "lower_limit_alarm_2": 3.0, "lower_limit_alarm_1": 2.0, "control_method": 1, "td_derivative_time": 41, "status": 0, "lower_limit_of_temperature_range": -20.0, "software_version": 1056, "upper_limit_of_temperature_range": 500.0, "communication_write_in_selection": 1, "heating_cooling_control_cycle": 22, "heating_cooling_control_selection": 1, "control_run_stop_setting": 0, "set_point": 18.5, "proportional_control_offset_error_value": 0.0, "upper_limit_alarm_2": 3.0, "input_temperature_sensor_type": 14, "pb_proportional_band": 2.0, "leds": 84,"lock_status":0}'
+EMU_ANSWERS = {
+			2: '{"i_offset":0,"output":0, "control_output": 0,"process_value": 1.4, "upper_limit_alarm_1": 2.0, "temperature_unit_display_selection": 1, "at_setting": 0, "heating_cooling_hysteresis": 0.1, "alarm_2_type": 1, "temperature_regulation_value": 0.0, "ti_integral_time": 10, "alarm_1_type": 1, "lower_limit_alarm_2": 3.0, "lower_limit_alarm_1": 2.0, "control_method": 1, "td_derivative_time": 41, "status": 0, "lower_limit_of_temperature_range": -20.0, "software_version": 1056, "upper_limit_of_temperature_range": 500.0, "communication_write_in_selection": 1, "heating_cooling_control_cycle": 22, "heating_cooling_control_selection": 1, "control_run_stop_setting": 1, "set_point": 1.5, "proportional_control_offset_error_value": 0.0, "upper_limit_alarm_2": 3.0, "input_temperature_sensor_type": 14, "pb_proportional_band": 2.0, "leds": 84,"lock_status":0}'
+}
+EMU_PORTS = '{"ports":["COM99"]}'
+
+"""Options understood here: option -> destination, and whether it takes a value."""
+OPTIONS = {
+			'-get': ('get', True),
+			'-set': ('set', True),
+			'-set_value': ('set_value', True),
+			'-port': ('port', True),
+			'-address': ('address', True),
+			'-j': ('json', False),
+			'--json': ('json', False),
+			'-e': ('emu', False),
+			'--emu': ('emu', False),
+			'--probe': ('probe', False)
+}
+
+def emu_answer(address):
+	return EMU_ANSWERS.get(address, EMU_ANSWER)
+
+def temp_dir():
+	"""tempfile.gettempdir() without importing tempfile."""
+	for name in ('TMPDIR', 'TEMP', 'TMP'):
+		if os.environ.get(name):
+			return os.environ[name]
+	if sys.platform.startswith('win'):
+		import tempfile
+		return tempfile.gettempdir()
+	return '/tmp'
+
+def private_dir():
+	"""Directory of the current user for the love8c files, None if it is not safe.
+	
+	On POSIX it is ``love8c-<uid>`` in the temp directory, mode 0700, and it must be
+	a real directory owned by the user, so another user can not plant links in it.
+	On Windows the temp directory is already per user.
+	"""
+	if not hasattr(os, 'getuid'):
+		return temp_dir()
+	import stat
+	path = os.path.join(temp_dir(), PRIVATE_DIR_PREFIX + str(os.getuid()))
+	try:
+		os.mkdir(path, 0o700)
+	except OSError:
+		pass
+	try:
+		info = os.lstat(path)
+	except OSError:
+		return None
+	if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+		return None
+	return path
+
+def ports_cache_file():
+	"""Path of the ports cache in :func:`private_dir`, None when there is no safe place."""
+	directory = private_dir()
+	if directory is None:
+		return None
+	return os.path.join(directory, PORTS_CACHE_NAME)
+
+def cached_ports(probe=False, max_age=PORTS_CACHE_SECONDS):
+	"""Ports list of the cache written by love8c.serial_ports, None when missing or old."""
+	import json
+	import time
+	path = ports_cache_file()
+	if path is None:
+		return None
+	try:
+		with open(path) as f:
+			cached = json.load(f).get(str(probe))
+	except (IOError, OSError, ValueError, AttributeError):
+		return None
+	if cached is None or not 0 <= time.time() - cached[0] < max_age:
+		return None
+	return list(cached[1])
+
+def parse_args(argv):
+	"""Parse the options of :data:`OPTIONS`, None when something else is given."""
+	args = {}
+	i = 0
+	while i < len(argv):
+		if argv[i] not in OPTIONS:
+			return None
+		dest, has_value = OPTIONS[argv[i]]
+		if has_value:
+			if i + 1 >= len(argv) or argv[i + 1].startswith('-') and dest != 'set_value':
+				return None
+			args[dest] = argv[i + 1]
+			i += 2
+		else:
+			args[dest] = args.get(dest, 0) + 1
+			i += 1
+	try:
+		if 'address' in args:
+			args['address'] = int(args['address'])
+		if 'set_value' in args:
+			args['set_value'] = float(args['set_value'])
+	except ValueError:
+		return None
+	return args
+
+def print_out(text):
+	sys.stdout.write(text + "\n")
+	sys.stdout.flush()
+
+def main(argv):
+	"""Answer the command of *argv* if it does not need a device. Returns True when answered."""
+	args = parse_args(argv)
+	if args is None:
+		return False
+	if 'port' not in args:
+		if args.get('json') and args.get('emu'):
+			print_out(EMU_PORTS)
+			return True
+		ports = cached_ports(args.get('probe', 0) > 0)
+		if ports is None:
+			return False
+		import json
+		if args.get('json'):
+			print_out(json.dumps({"ports": ports}))
+		else:
+			print_out("Need set the port, Ex: -port COM3")
+			print_out("Avaible:")
+			print_out(json.dumps(ports))
+		return True
+	if not args.get('emu') or 'address' not in args or not ('get' in args or 'set' in args):
+		return False
+	if 'set' in args:
+		if 'set_value' in args:
+			return True
+		print_out("Need set the value with -set_value")
+	if 'get' not in args:
+		return True
+	emu = emu_answer(args['address'])
+	if args['get'] == "all":
+		print_out(emu)
+		return True
+	import json
+	fake_data = json.loads(emu)
+	data = {}
+	names = [x.strip() for x in args['get'].split(",")]
+	for propName in names:
+		data[propName] = 'N/D'
+		if (propName in fake_data):
+			data[propName] = fake_data[propName]
+		else:
+			print_out("No " + propName)
+		if not args.get('json'):
+			print_out(propName + ":" + str(data[propName]))
+	if args.get('json'):
+		print_out(json.dumps(data))
+	return True
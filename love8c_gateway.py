@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Modbus TCP gateway for Love 8C controllers, started with ``love8c.py --gateway``.
+
+Modbus TCP clients (HMI, historian...) reach the slaves of the serial buses
+through one TCP server: the unit id is the slave address and the register
+addresses are the ones of the controller (:data:`love8c.REGISTER_START`), so
+``read holding registers 0x4700, 1`` on unit 1 reads ``process_value`` of slave 1.
+Function codes 3 (read holding registers) and 6 (write single register) are
+served.
+
+Each bus has one worker with a request queue. The reads queued while the bus
+was busy are merged per slave into as few serial reads as possible (ranges
+that overlap or are :data:`love8c.BLOCK_MAX_GAP` apart, up to
+:data:`love8c.BLOCK_MAX_REGISTERS` registers). A read whose registers were
+all read less than *freshness* seconds ago is answered from those values
+without using the bus. A write is done in arrival order and clears the cached
+value of the register. The serial reads and writes are transactions of
+:meth:`love8c.Love8C.get_words` and :meth:`love8c.Love8C.set_word`, so they are
+in the statistics and wait for the ``arbiter`` of the instrument (``--arbitrate``).
+
+"""
+
+import time
+import struct
+import threading
+
+try:
+	import queue
+	from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+	import Queue as queue
+	from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+DEFAULT_GATEWAY_LISTEN = '127.0.0.1:5020'
+
+"""Seconds a read answer is reused for the same registers."""
+GATEWAY_FRESHNESS = love8c.CACHE_TTL_DEFAULT
+"""Seconds a client request waits for the bus before a gateway error."""
+GATEWAY_TIMEOUT = 5.0
+
+"""Modbus exception codes sent to the clients."""
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+SLAVE_DEVICE_FAILURE = 4
+GATEWAY_PATH_UNAVAILABLE = 10
+GATEWAY_TARGET_FAILED = 11
+
+"""Most registers of one function 3 request (Modbus limit)."""
+MAX_READ_COUNT = 125
+
+def exception_code(ex, instr):
+	"""Modbus exception code for a failed serial transaction."""
+	if isinstance(ex, love8c.NoResponseError):
+		return GATEWAY_TARGET_FAILED
+	if instr.last_exception_code is not None:
+		return instr.last_exception_code
+	return SLAVE_DEVICE_FAILURE
+
+
+class GatewayRequest(object):
+	"""One client request, answered with the response PDU.
+
+	A request is "queued" until the worker claims it for the bus ("started"), or
+	"abandoned" when the client stopped waiting first: it is then never sent.
+	"""
+
+	def __init__(self, address, functioncode, first, second):
+		self.address = address
+		self.functioncode = functioncode
+		self.first = first
+		self.second = second
+		self.response = None
+		self.done = threading.Event()
+		self.state = "queued"
+		self.lock = threading.Lock()
+
+	def claim(self):
+		"""Mark the request started by the worker, False if it was abandoned."""
+		with self.lock:
+			if self.state == "abandoned":
+				return False
+			self.state = "started"
+			return True
+
+	def abandon(self):
+		"""Mark the request abandoned by the client, False if the worker already started it."""
+		with self.lock:
+			if self.state == "started":
+				return False
+			self.state = "abandoned"
+			return True
+
+	def answer(self, pdu):
+		self.response = pdu
+		self.done.set()
+
+	def answer_words(self, words):
+		self.answer(struct.pack('>BB', 3, 2 * len(words)) + struct.pack('>' + 'H' * len(words), *words))
+
+	def answer_error(self, code):
+		self.answer(struct.pack('>BB', self.functioncode | 0x80, code))
+
+
+class BusGateway(object):
+	"""Request queue and worker of one serial bus.
+
+	Args:
+		* portname (str): port name
+		* addresses (list): slave addresses on the bus
+		* instrument_factory: called as instrument_factory(portname, address), :class:`love8c.Love8C` by default
+		* freshness (float): seconds a read answer is reused
+	"""
+
+	def __init__(self, portname, addresses, instrument_factory=None, freshness=GATEWAY_FRESHNESS):
+		if instrument_factory is None:
+			instrument_factory = love8c.Love8C
+		self.portname = portname
+		self.freshness = freshness
+		self.instruments = {}
+		for address in addresses:
+			instr = instrument_factory(portname, address)
+			instr.close_port_after_each_call = False
+			self.instruments[address] = instr
+		self.queue = queue.Queue()
+		#address -> register -> (time read, raw value)
+		self.words = dict((x, {}) for x in self.instruments)
+		self.lock = threading.Lock()
+		self.serial_reads = 0
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def cached(self, request):
+		"""Words of a read from the values younger than the freshness window, None if any is missing."""
+		now = time.time()
+		words = []
+		with self.lock:
+			cache = self.words[request.address]
+			for register in range(request.first, request.first + request.second):
+				if register not in cache or now - cache[register][0] > self.freshness:
+					return None
+				words.append(cache[register][1])
+		return words
+
+	def submit(self, request, timeout=GATEWAY_TIMEOUT):
+		"""Answer a request, from the cache or through the queue. Returns the response PDU."""
+		if request.functioncode == 3:
+			words = self.cached(request)
+			if words is not None:
+				request.answer_words(words)
+				return request.response
+		self.queue.put(request)
+		if not request.done.wait(timeout):
+			if request.abandon():
+				return struct.pack('>BB', request.functioncode | 0x80, GATEWAY_TARGET_FAILED)
+			#Already on the bus, the client gets its real outcome
+			request.done.wait()
+		return request.response
+
+	def run(self):
+		while True:
+			batch = [self.queue.get()]
+			while True:
+				try:
+					batch.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				self.process(batch)
+			except Exception:
+				for request in batch:
+					if not request.done.is_set():
+						request.answer_error(SLAVE_DEVICE_FAILURE)
+
+	def process(self, batch):
+		"""Serve a batch in arrival order, the reads of a slave up to its next write are merged.
+
+		The requests abandoned by their clients are left out.
+		"""
+		reads = {}
+		for request in batch:
+			if request.functioncode == 3:
+				reads.setdefault(request.address, []).append(request)
+				continue
+			if request.address in reads:
+				self.read(request.address, reads.pop(request.address))
+			self.write(request)
+		for address, requests in reads.items():
+			self.read(address, requests)
+
+	def read(self, address, requests):
+		#Values read since the request was queued are fresh enough
+		pending = []
+		for request in requests:
+			if not request.claim():
+				continue
+			words = self.cached(request)
+			if words is not None:
+				request.answer_words(words)
+			else:
+				pending.append(request)
+		pending.sort(key=lambda x: x.first)
+		spans = []
+		for request in pending:
+			if spans:
+				start, end, members = spans[-1]
+				new_end = max(end, request.first + request.second - 1)
+				if request.first <= end + love8c.BLOCK_MAX_GAP + 1 and new_end - start + 1 <= love8c.BLOCK_MAX_REGISTERS:
+					spans[-1] = (start, new_end, members + [request])
+					continue
+			spans.append((request.first, request.first + request.second - 1, [request]))
+		instr = self.instruments[address]
+		for start, end, members in spans:
+			try:
+				words = instr.get_words(start, end - start + 1)
+			except Exception as ex:
+				if len(members) > 1:
+					#One bad range must not fail the other clients
+					for request in members:
+						self.read(address, [request])
+				else:
+					members[0].answer_error(exception_code(ex, instr))
+				continue
+			self.serial_reads += 1
+			now = time.time()
+			with self.lock:
+				cache = self.words[address]
+				for offset, word in enumerate(words):
+					cache[start + offset] = (now, word)
+			for request in members:
+				request.answer_words(words[request.first - start:request.first - start + request.second])
+
+	def write(self, request):
+		if not request.claim():
+			return
+		instr = self.instruments[request.address]
+		with self.lock:
+			self.words[request.address].pop(request.first, None)
+		try:
+			instr.set_word(request.first, request.second)
+		except Exception as ex:
+			request.answer_error(exception_code(ex, instr))
+			return
+		request.answer(struct.pack('>BHH', 6, request.first, request.second))
+
+	def close(self):
+		for instr in self.instruments.values():
+			instr.serial.close()
+
+
+class ModbusTCPHandler(StreamRequestHandler):
+	"""Modbus TCP connection, requests are answered in order."""
+
+	def handle(self):
+		while True:
+			header = self.rfile.read(7)
+			if len(header) < 7:
+				return
+			transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+			if protocol != 0 or not 2 <= length <= 254:
+				return
+			pdu = self.rfile.read(length - 1)
+			if len(pdu) < length - 1:
+				return
+			response = self.server.dispatch(unit, bytearray(pdu))
+			self.wfile.write(struct.pack('>HHHB', transaction, 0, len(response) + 1, unit) + response)
+			self.wfile.flush()
+
+
+class GatewayServer(ThreadingMixIn, TCPServer):
+	"""Modbus TCP server in front of one :class:`BusGateway` per bus.
+
+	Args:
+		* buses (dict): port name -> slave addresses, an address can be on one bus only
+		* listen (str): 'host:port' to listen on
+		* instrument_factory: called as instrument_factory(portname, address), :class:`love8c.Love8C` by default
+		* freshness (float): seconds a read answer is reused
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, buses, listen=DEFAULT_GATEWAY_LISTEN, instrument_factory=None, freshness=GATEWAY_FRESHNESS):
+		self.units = {}
+		for portname, addresses in buses.items():
+			for address in addresses:
+				if address in self.units:
+					raise ValueError('Address {0} is on more than one bus, the unit id must be unique'.format(address))
+				self.units[address] = portname
+		self.gateways = {}
+		host, port = listen.rsplit(':', 1)
+		TCPServer.__init__(self, (host, int(port)), ModbusTCPHandler)
+		for portname, addresses in buses.items():
+			self.gateways[portname] = BusGateway(portname, addresses, instrument_factory, freshness)
+			self.gateways[portname].start()
+
+	def dispatch(self, unit, pdu):
+		"""Response PDU of a request PDU for a unit id."""
+		functioncode = pdu[0]
+		if functioncode not in (3, 6):
+			return struct.pack('>BB', functioncode | 0x80, ILLEGAL_FUNCTION)
+		if len(pdu) != 5:
+			return struct.pack('>BB', functioncode | 0x80, ILLEGAL_DATA_VALUE)
+		if unit not in self.units:
+			return struct.pack('>BB', functioncode | 0x80, GATEWAY_PATH_UNAVAILABLE)
+		first, second = struct.unpack('>HH', bytes(pdu[1:]))
+		if functioncode == 3 and not 1 <= second <= MAX_READ_COUNT:
+			return struct.pack('>BB', functioncode | 0x80, ILLEGAL_DATA_VALUE)
+		return self.gateways[self.units[unit]].submit(GatewayRequest(unit, functioncode, first, second))
+
+	def server_close(self):
+		TCPServer.server_close(self)
+		for gateway in self.gateways.values():
+			gateway.close()
+
+
+def serve_gateway(buses, listen=DEFAULT_GATEWAY_LISTEN, instrument_factory=None, freshness=GATEWAY_FRESHNESS):
+	"""Run the gateway until interrupted."""
+	server = GatewayServer(buses, listen, instrument_factory, freshness)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
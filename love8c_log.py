@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Time-series logger for Love 8C controllers, started with ``love8c.py --log``.
+
+Samples go to append-only binary files of fixed-width records, a new file
+every :data:`ROLLOVER_SECONDS` or :data:`ROLLOVER_BYTES`. A file is a header
+(:data:`LOG_MAGIC`, the header length as uint32 and a JSON description with the
+register names and ports) followed by records of :data:`RECORD_HEAD` (time as
+float64, port index, slave address, flags) plus one float32 per register, NaN
+when the value is missing. Records are kept in time order, so the reader maps
+the files and finds a time range by bisection::
+
+	love8c_log.py logs -start 1476700000 -every 60
+
+"""
+
+import os
+import sys
+import time
+import json
+import math
+import mmap
+import struct
+import argparse
+import threading
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Registers logged when none are given."""
+LOG_NAMES = ['process_value', 'set_point', 'output', 'leds']
+LOG_INTERVAL = 1.0
+
+"""Start a new file after this many seconds or bytes."""
+ROLLOVER_SECONDS = 86400
+ROLLOVER_BYTES = 64 * 1024 * 1024
+
+LOG_MAGIC = b'L8CLOG\x00\x01'
+LOG_PREFIX = 'love8c'
+LOG_SUFFIX = '.l8c'
+
+"""Record head: time, port index, slave address, flags. One float32 per register follows."""
+RECORD_HEAD = '<dBBH'
+FLAG_ERROR = 1
+
+def record_struct(count):
+	return struct.Struct(RECORD_HEAD + 'f' * count)
+
+def log_files(directory, prefix=LOG_PREFIX):
+	"""Log files of a directory, oldest first (the names carry the UTC start time)."""
+	names = [x for x in os.listdir(directory) if x.startswith(prefix + '-') and x.endswith(LOG_SUFFIX)]
+	return [os.path.join(directory, x) for x in sorted(names)]
+
+
+class LogWriter(object):
+	"""Append samples to rolling log files.
+
+	Args:
+		* directory (str): where the files are written
+		* names (list): logged registers, in record order
+		* ports (list): port names, a record stores the index
+		* interval (float): sample period, kept in the header for readers
+		* rollover (float): seconds before starting a new file
+		* max_bytes (int): size before starting a new file
+	"""
+
+	def __init__(self, directory, names, ports, interval=LOG_INTERVAL, rollover=ROLLOVER_SECONDS, max_bytes=ROLLOVER_BYTES, prefix=LOG_PREFIX):
+		self.directory = directory
+		self.names = list(names)
+		self.ports = list(ports)
+		self.interval = interval
+		self.rollover = rollover
+		self.max_bytes = max_bytes
+		self.prefix = prefix
+		self.record = record_struct(len(self.names))
+		self.file = None
+		self.path = None
+		self.opened = None
+		self.size = 0
+		self.last_time = 0
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def _open(self, timestamp):
+		self.close()
+		stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(timestamp))
+		self.path = os.path.join(self.directory, '{0}-{1}{2}'.format(self.prefix, stamp, LOG_SUFFIX))
+		header = json.dumps({
+			"names": self.names,
+			"ports": self.ports,
+			"interval": self.interval,
+			"created": timestamp,
+			"record": self.record.format if isinstance(self.record.format, str) else self.record.format.decode('ascii')
+		}).encode('utf-8')
+		self.file = open(self.path, 'ab')
+		if self.file.tell() == 0:
+			self.file.write(LOG_MAGIC + struct.pack('<I', len(header)) + header)
+		self.size = self.file.tell()
+		self.opened = timestamp
+
+	def write(self, portname, address, timestamp, data):
+		"""Append one sample, *data* is a dict name -> value or a :func:`love8c.error_data` dict."""
+		#Keep the records in time order, samples of parallel buses may arrive a little late
+		timestamp = max(timestamp, self.last_time)
+		if self.file is None or timestamp - self.opened >= self.rollover or self.size >= self.max_bytes:
+			self._open(timestamp)
+		flags = 0
+		if "error" in data:
+			flags |= FLAG_ERROR
+		values = [float(data[x]) if data.get(x) is not None else float('nan') for x in self.names]
+		self.file.write(self.record.pack(timestamp, self.ports.index(portname), address, flags, *values))
+		self.file.flush()
+		self.size += self.record.size
+		self.last_time = timestamp
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
+class LogFile(object):
+	"""Memory mapped log file. Records are read on demand, the file is never loaded whole.
+
+	Records are (time, port, address, data), data is a dict name -> value (None
+	when missing) or None for a failed read.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			head = f.read(len(LOG_MAGIC) + 4)
+			if len(head) < len(LOG_MAGIC) + 4 or head[:len(LOG_MAGIC)] != LOG_MAGIC:
+				raise ValueError('Not a Love 8C log file: {0}'.format(path))
+			length = struct.unpack('<I', head[len(LOG_MAGIC):])[0]
+			self.header = json.loads(f.read(length).decode('utf-8'))
+			self.offset = len(head) + length
+			size = os.fstat(f.fileno()).st_size
+			self.map = None
+			if size > self.offset:
+				self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.names = self.header["names"]
+		self.ports = self.header["ports"]
+		self.record = record_struct(len(self.names))
+		#A record cut by a crash at the end of the file is left out
+		self.count = max(0, size - self.offset) // self.record.size
+		self.decimals = []
+		for name in self.names:
+			reg = love8c.REGISTERS.get(name)
+			self.decimals.append(reg.decimals if reg is not None else None)
+
+	def __len__(self):
+		return self.count
+
+	def time(self, index):
+		return struct.unpack_from('<d', self.map, self.offset + index * self.record.size)[0]
+
+	def find(self, timestamp):
+		"""Index of the first record at or after *timestamp*."""
+		low, high = 0, self.count
+		while low < high:
+			middle = (low + high) // 2
+			if self.time(middle) < timestamp:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	def decode(self, index):
+		fields = self.record.unpack_from(self.map, self.offset + index * self.record.size)
+		timestamp, port, address, flags = fields[:4]
+		data = None
+		if not flags & FLAG_ERROR:
+			data = {}
+			for name, decimals, value in zip(self.names, self.decimals, fields[4:]):
+				if math.isnan(value):
+					value = None
+				elif decimals == 0:
+					value = int(value)
+				elif decimals is not None:
+					value = round(value, decimals)
+				data[name] = value
+		return timestamp, self.ports[port], address, data
+
+	def records(self, start=None, end=None):
+		"""Yield the records from *start* (included) to *end* (excluded), both optional."""
+		first = 0 if start is None or not self.count else self.find(start)
+		last = self.count if end is None or not self.count else self.find(end)
+		for index in range(first, last):
+			yield self.decode(index)
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+
+
+def read_log(directory, start=None, end=None, prefix=LOG_PREFIX):
+	"""Yield the records of every log file of a directory between *start* and *end*, oldest first."""
+	paths = log_files(directory, prefix)
+	for i, path in enumerate(paths):
+		log = LogFile(path)
+		try:
+			if end is not None and log.header["created"] >= end:
+				break
+			if start is not None and i + 1 < len(paths) and len(log) and log.time(len(log) - 1) < start:
+				continue
+			for record in log.records(start, end):
+				yield record
+		finally:
+			log.close()
+
+def downsample(records, seconds):
+	"""Aggregate records into buckets of *seconds* per device.
+
+	Yields (bucket start, port, address, data) in time order, data is a dict
+	name -> {"min", "mean", "max", "count"} of the values in the bucket.
+	"""
+	bucket = None
+	stats = {}
+	def flush():
+		for key in sorted(stats):
+			data = {}
+			for name, (low, total, high, count) in stats[key].items():
+				data[name] = {"min": low, "mean": total / count, "max": high, "count": count}
+			yield (bucket, key[0], key[1], data)
+	for timestamp, port, address, data in records:
+		current = math.floor(timestamp / seconds) * seconds
+		if current != bucket:
+			for item in flush():
+				yield item
+			bucket = current
+			stats = {}
+		if data is None:
+			continue
+		device = stats.setdefault((port, address), {})
+		for name, value in data.items():
+			if value is None:
+				continue
+			if name in device:
+				low, total, high, count = device[name]
+				device[name] = (min(low, value), total + value, max(high, value), count + 1)
+			else:
+				device[name] = (value, value, value, 1)
+	for item in flush():
+		yield item
+
+
+def log(buses, directory, names=None, interval=LOG_INTERVAL, instrument_factory=None, stop_event=None, rollover=ROLLOVER_SECONDS, max_bytes=ROLLOVER_BYTES, on_error=None):
+	"""Sample *names* from every slave every *interval* seconds into :class:`LogWriter` files.
+
+	Each bus is read by its own worker (see :meth:`love8c_bus.Fleet.run_buses`), the
+	samples are written from the calling thread until *stop_event* is set. A bus
+	too slow for the interval skips the missed samples instead of falling behind.
+	A failed read, or a port that can not be opened (tried again every interval),
+	is written as an error record and given to on_error(portname, address, data)
+	when the device starts failing, data is a :func:`love8c.error_data` dict.
+	"""
+	import love8c_bus
+	if names is None:
+		names = LOG_NAMES
+	if instrument_factory is None:
+		instrument_factory = love8c.Love8C
+	if stop_event is None:
+		stop_event = threading.Event()
+	def worker(portname, addresses, put):
+		instruments = dict((x, None) for x in addresses)
+		try:
+			due = time.time()
+			while not stop_event.is_set():
+				for address in addresses:
+					now = time.time()
+					try:
+						if instruments[address] is None:
+							instr = instrument_factory(portname, address)
+							instr.close_port_after_each_call = False
+							instruments[address] = instr
+						data = instruments[address].get_registers(names)
+					except Exception as ex:
+						data = love8c.error_data(ex)
+					put((portname, address, now, data))
+				due = max(due + interval, time.time())
+				stop_event.wait(due - time.time())
+		finally:
+			for instr in instruments.values():
+				if instr is not None:
+					instr.serial.close()
+	writer = LogWriter(directory, names, sorted(buses), interval, rollover, max_bytes)
+	failing = set()
+	try:
+		for portname, address, timestamp, data in love8c_bus.Fleet(buses, instrument_factory).run_buses(worker):
+			writer.write(portname, address, timestamp, data)
+			if "error" not in data:
+				failing.discard((portname, address))
+			elif (portname, address) not in failing:
+				failing.add((portname, address))
+				if on_error is not None:
+					on_error(portname, address, data)
+	finally:
+		stop_event.set()
+		writer.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Read Love 8C log files, one json line per record.')
+	parser.add_argument('directory', help='Directory of the log files')
+	parser.add_argument('-start', metavar='time', nargs=1, type=float, help='First time (unix seconds)')
+	parser.add_argument('-end', metavar='time', nargs=1, type=float, help='End time (unix seconds, excluded)')
+	parser.add_argument('-every', metavar='seconds', nargs=1, type=float, help='Downsample to min/mean/max of each period')
+	args = parser.parse_args()
+
+	start = args.start[0] if args.start else None
+	end = args.end[0] if args.end else None
+	records = read_log(args.directory, start, end)
+	if args.every:
+		records = downsample(records, args.every[0])
+	try:
+		for timestamp, port, address, data in records:
+			sys.stdout.write(json.dumps({"time": timestamp, "port": port, "address": address, "data": data}) + '\n')
+	except KeyboardInterrupt:
+		pass
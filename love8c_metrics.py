@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Prometheus exporter for Love 8C controllers, started with ``love8c.py --metrics``.
+
+The buses are polled in the background (:meth:`love8c_bus.Fleet.poll`) and
+``GET /metrics`` is answered from the latest values, so any number of scrapes
+adds no bus traffic. Every readable register is a gauge ``love8c_<name>``
+labelled with port and address; the enumerated registers and the leds bits
+are also state sets ``love8c_<name>_state``. The OpenMetrics format is sent
+when the scraper asks for it, the Prometheus text format otherwise.
+
+"""
+
+import threading
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+DEFAULT_METRICS_LISTEN = '127.0.0.1:9688'
+METRIC_PREFIX = 'love8c_'
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+def escape_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def escape_help(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n')
+
+
+class MetricsCache(object):
+	"""Latest values of every slave, updated by the poller and read by the scrapes.
+
+	A slave whose last read failed is reported down and its values are left out,
+	so a scrape never shows old values as current ones.
+	"""
+
+	def __init__(self):
+		self.devices = {}
+		self.version = 0
+		self.lock = threading.Lock()
+
+	def update(self, portname, address, data, timestamp):
+		"""Poll callback, data is a dict name -> value or a :func:`love8c.error_data` dict."""
+		with self.lock:
+			device = self.devices.setdefault((portname, address), {"values": {}, "up": False, "time": None})
+			if "error" in data:
+				device["up"] = False
+				device["values"] = {}
+			else:
+				device["up"] = True
+				device["time"] = timestamp
+				device["values"].update(data)
+			self.version += 1
+
+	def snapshot(self):
+		"""(version, {(port, address): device}) with copies of the device dicts."""
+		with self.lock:
+			devices = {}
+			for key, device in self.devices.items():
+				devices[key] = {"values": dict(device["values"]), "up": device["up"], "time": device["time"]}
+			return self.version, devices
+
+
+def render(devices, openmetrics=False):
+	"""Exposition text of a :meth:`MetricsCache.snapshot`."""
+	lines = []
+	keys = sorted(devices)
+	def family(name, kind, help_text, samples):
+		if openmetrics and kind == 'stateset':
+			lines.append('# TYPE {0} stateset'.format(name))
+		else:
+			lines.append('# TYPE {0} {1}'.format(name, 'gauge' if kind == 'stateset' else kind))
+		lines.append('# HELP {0} {1}'.format(name, escape_help(help_text)))
+		for labels, value in samples:
+			text = ','.join('{0}="{1}"'.format(k, escape_label(v)) for k, v in labels)
+			lines.append('{0}{{{1}}} {2}'.format(name, text, value))
+	def device_labels(key):
+		return [('port', key[0]), ('address', key[1])]
+	family(METRIC_PREFIX + 'up', 'gauge', 'Last read of the device succeeded',
+		[(device_labels(k), 1 if devices[k]["up"] else 0) for k in keys])
+	family(METRIC_PREFIX + 'last_read_timestamp_seconds', 'gauge', 'Time of the last successful read',
+		[(device_labels(k), devices[k]["time"]) for k in keys if devices[k]["time"] is not None])
+	for name in love8c.REGISTER_READ_DETAIL:
+		samples = []
+		states = []
+		state_name = METRIC_PREFIX + name + '_state'
+		for key in keys:
+			value = devices[key]["values"].get(name)
+			if value is None:
+				continue
+			samples.append((device_labels(key), value))
+			if name in love8c.REGISTER_ENUMS:
+				for code, text in sorted(love8c.REGISTER_ENUMS[name].items()):
+					states.append((device_labels(key) + [(state_name, text)], 1 if value == code else 0))
+			elif name == 'leds':
+				for led, lit in sorted(love8c.decode_leds(int(value)).items()):
+					states.append((device_labels(key) + [(state_name, led)], lit))
+		family(METRIC_PREFIX + name, 'gauge', love8c.REGISTER_LABELS.get(name, name), samples)
+		if name in love8c.REGISTER_ENUMS or name == 'leds':
+			family(state_name, 'stateset', love8c.REGISTER_LABELS.get(name, name), states)
+	if openmetrics:
+		lines.append('# EOF')
+	return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split('?', 1)[0] != '/metrics':
+			self.send_error(404)
+			return
+		openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+		body = self.server.body(openmetrics)
+		self.send_response(200)
+		self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_TEXT)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+	"""HTTP server of ``/metrics`` from a :class:`MetricsCache`.
+
+	The text is rendered again only after the cache changes, scrapes in between
+	get the same bytes.
+
+	Args:
+		* listen (str): 'host:port' to listen on
+		* cache (MetricsCache): values to export
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, listen=DEFAULT_METRICS_LISTEN, cache=None):
+		host, port = listen.rsplit(':', 1)
+		HTTPServer.__init__(self, (host, int(port)), MetricsRequestHandler)
+		self.cache = cache if cache is not None else MetricsCache()
+		self._rendered = {}
+		self._lock = threading.Lock()
+
+	def body(self, openmetrics=False):
+		with self._lock:
+			version, body = self._rendered.get(openmetrics, (None, None))
+			if version != self.cache.version:
+				version, devices = self.cache.snapshot()
+				body = render(devices, openmetrics).encode('utf-8')
+				self._rendered[openmetrics] = (version, body)
+			return body
+
+
+def serve_metrics(buses, listen=DEFAULT_METRICS_LISTEN, names=None, rates=None, instrument_factory=None):
+	"""Poll *buses* (port name -> addresses) in the background and serve their metrics until interrupted."""
+	import love8c_bus
+	cache = MetricsCache()
+	stop_event = threading.Event()
+	fleet = love8c_bus.Fleet(buses, instrument_factory)
+	poller = threading.Thread(target=fleet.poll, args=(cache.update, names, rates, stop_event))
+	poller.daemon = True
+	poller.start()
+	server = MetricsServer(listen, cache)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stop_event.set()
+		server.server_close()
+		poller.join(5)
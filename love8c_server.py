@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Daemon for the Love 8C driver, started with ``love8c.py --serve``.
+
+Keeps the serial ports open between requests and answers them over loopback HTTP,
+with the same JSON as the ``-j`` output of the command line. ``/set`` changes the
+controller, it is served only for POST with a JSON body: a web page open in a
+browser of the host can not send that without a CORS preflight, which the daemon
+does not answer. Requests with an ``Origin`` other than the daemon, or a ``Host``
+that is a domain name other than localhost (DNS rebinding), are refused::
+
+	GET /ports
+	GET /get?port=COM3&address=1&names=all
+	GET /get?port=COM3&address=1&names=process_value,set_point
+	POST /set  {"port": "COM3", "address": 1, "name": "set_point", "value": 8.5}
+	GET /stats
+	GET /stats?port=COM3
+
+"""
+
+import json
+import socket
+import threading
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+DEFAULT_LISTEN = '127.0.0.1:8988'
+
+
+class Love8CPool(object):
+	"""Persistent :class:`love8c.Love8C` instruments, one lock per serial port.
+
+	Requests to the same port are serialized, requests to different ports run
+	concurrently.
+
+	Args:
+		* ports (list): allowed port names, None to allow any port
+		* cache (bool): wrap the instruments in a :class:`love8c.RegisterCache`
+		* instrument_factory: called as instrument_factory(portname, address), :class:`love8c.Love8C` by default
+	"""
+
+	def __init__(self, ports=None, cache=False, instrument_factory=None):
+		self.ports = ports
+		self.cache = cache
+		self.instrument_factory = instrument_factory
+		if self.instrument_factory is None:
+			self.instrument_factory = love8c.Love8C
+		self._instruments = {}
+		self._locks = {}
+		self._lock = threading.Lock()
+
+	def port_lock(self, portname):
+		with self._lock:
+			if portname not in self._locks:
+				self._locks[portname] = threading.Lock()
+			return self._locks[portname]
+
+	def instrument(self, portname, slaveaddress):
+		"""Return the open instrument for a port and address, the caller must hold the port lock."""
+		if (self.ports is not None) and (portname not in self.ports):
+			raise ValueError('Port not served: {0}'.format(portname))
+		key = (portname, slaveaddress)
+		if key not in self._instruments:
+			instr = self.instrument_factory(portname, slaveaddress)
+			instr.close_port_after_each_call = False
+			if self.cache:
+				instr = love8c.RegisterCache(instr)
+			self._instruments[key] = instr
+		return self._instruments[key]
+
+	def get(self, portname, slaveaddress, names):
+		with self.port_lock(portname):
+			return self.instrument(portname, slaveaddress).get_registers(names)
+
+	def set(self, portname, slaveaddress, name, value):
+		with self.port_lock(portname):
+			return self.instrument(portname, slaveaddress).set_register(name, value)
+
+	def close(self):
+		with self._lock:
+			for instr in self._instruments.values():
+				instr.serial.close()
+			self._instruments = {}
+
+
+"""Largest request body accepted (bytes)."""
+MAX_BODY = 4096
+
+def is_ip_address(host):
+	for family in (socket.AF_INET, socket.AF_INET6):
+		try:
+			socket.inet_pton(family, host)
+			return True
+		except (socket.error, ValueError, AttributeError):
+			pass
+	return False
+
+def local_netloc(netloc, port):
+	"""True if a 'host:port' names this server by IP address or localhost, on *port*."""
+	if ':' not in netloc or netloc.endswith(']'):
+		host, text = netloc, '80'
+	else:
+		host, text = netloc.rsplit(':', 1)
+	host = host.strip('[]').lower()
+	if text != str(port):
+		return False
+	return host == 'localhost' or is_ip_address(host)
+
+class Love8CRequestHandler(BaseHTTPRequestHandler):
+
+	def send_status(self, code, allow=None):
+		self.send_response(code)
+		if allow is not None:
+			self.send_header('Allow', allow)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def allowed(self):
+		"""Refuse (403) the requests sent by a web page of another origin or through a domain name."""
+		port = self.server.server_address[1]
+		origin = self.headers.get('Origin')
+		if not local_netloc(self.headers.get('Host', ''), port) or (origin is not None and not (origin.startswith('http://') and local_netloc(origin[len('http://'):], port))):
+			self.send_status(403)
+			return False
+		return True
+
+	def do_GET(self):
+		if not self.allowed():
+			return
+		url = urlparse(self.path)
+		if url.path in self.server.post_routes:
+			self.send_status(405, 'POST')
+			return
+		query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+		try:
+			data = self.server.dispatch(url.path, query)
+		except Exception as ex:
+			data = love8c.error_data(ex)
+		self.send_json(data)
+
+	def do_POST(self):
+		if not self.allowed():
+			return
+		url = urlparse(self.path)
+		if url.path not in self.server.post_routes:
+			self.send_status(405, 'GET')
+			return
+		if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+			self.send_status(415)
+			return
+		try:
+			data = self.server.dispatch_post(url.path, self.read_body())
+		except Exception as ex:
+			data = love8c.error_data(ex)
+		self.send_json(data)
+
+	def read_body(self):
+		"""Parameters of a JSON object body."""
+		length = int(self.headers.get('Content-Length') or 0)
+		if length > MAX_BODY:
+			raise ValueError('Request body too large')
+		data = json.loads(self.rfile.read(length).decode('utf-8'))
+		if not isinstance(data, dict):
+			raise ValueError('The JSON body must be an object')
+		return data
+
+	def send_json(self, data):
+		body = json.dumps(data).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class Love8CServer(ThreadingMixIn, HTTPServer):
+	"""Loopback HTTP server answering get/set requests from a :class:`Love8CPool`.
+
+	Args:
+		* listen (str): 'host:port' to listen on
+		* ports (list): allowed port names, None to allow any port
+		* cache (bool): answer reads from a :class:`love8c.RegisterCache`
+		* instrument_factory: called as instrument_factory(portname, address), :class:`love8c.Love8C` by default
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, listen=DEFAULT_LISTEN, ports=None, cache=False, instrument_factory=None):
+		host, port = listen.rsplit(':', 1)
+		HTTPServer.__init__(self, (host, int(port)), Love8CRequestHandler)
+		self.pool = Love8CPool(ports, cache, instrument_factory)
+		self.routes = {
+			'/ports': self.route_ports,
+			'/get': self.route_get,
+			'/stats': self.route_stats
+		}
+		self.post_routes = {
+			'/set': self.route_set
+		}
+
+	def dispatch(self, path, query):
+		if path not in self.routes:
+			raise ValueError('Unknown path: {0}'.format(path))
+		return self.routes[path](query)
+
+	def dispatch_post(self, path, params):
+		return self.post_routes[path](params)
+
+	def route_ports(self, query):
+		data = {}
+		if self.pool.ports is not None:
+			data["ports"] = self.pool.ports
+		else:
+			data["ports"] = love8c.serial_ports()
+		return data
+
+	def route_get(self, query):
+		names = query.get('names', 'all')
+		if (names == "all"):
+			names = list(love8c.REGISTER_READ_DETAIL)
+		else:
+			names = [x.strip() for x in names.split(",")]
+		return self.pool.get(query['port'], int(query['address']), names)
+
+	def route_set(self, query):
+		name = query['name']
+		value = float(query['value'])
+		data = {}
+		data["name"] = name
+		data["value"] = value
+		data["result"] = self.pool.set(query['port'], int(query['address']), name, value)
+		return data
+
+	def route_stats(self, query):
+		return love8c.transaction_stats(query.get('port'))
+
+	def server_close(self):
+		HTTPServer.server_close(self)
+		self.pool.close()
+
+
+def serve(listen=DEFAULT_LISTEN, ports=None, cache=False, instrument_factory=None):
+	"""Run the daemon until interrupted."""
+	server = Love8CServer(listen, ports, cache, instrument_factory)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
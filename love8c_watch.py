@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Mauricio Galetto
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""
+
+.. moduleauthor:: Mauricio Galetto
+
+Change events of Love 8C controllers, started with ``love8c.py --watch``.
+
+The buses are polled (:meth:`love8c_bus.Fleet.poll`) and only the changes are
+reported, as dicts::
+
+	{"time": 1476700000.1, "port": "COM3", "address": 1, "event": "change",
+	 "name": "status", "value": 3, "previous": 0,
+	 "text": "Temperature sensor is not connected", "previous_text": "Normal operation (No error)"}
+
+Events are "initial" (first value of every watched register), "change" (a
+value moved, by at least its deadband for :data:`DEADBANDS`), "led" (one bit of
+the leds register flipped, with its name in "led") and "error" (the device
+stopped answering, with the :func:`love8c.error_data` dict in "error").
+
+"""
+
+import threading
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import love8c
+
+__author__  = "Mauricio Galetto "
+__license__ = "Apache License, Version 2.0"
+
+
+"""Registers watched when none are given."""
+WATCH_NAMES = ['process_value', 'status', 'leds', 'lock_status']
+
+"""Smallest change reported, in register units. Other registers report any change."""
+DEADBANDS = {
+			'process_value': 0.5
+}
+
+
+class ChangeDetector(object):
+	"""Turn successive reads of the slaves into change events.
+
+	A value is compared with the last reported one, not with the last read, so a
+	slow drift is reported once it adds up to the deadband.
+
+	Args:
+		* deadbands (dict): name -> smallest reported change, overrides :data:`DEADBANDS`
+		* initial (bool): report the first value of every register
+	"""
+
+	def __init__(self, deadbands=None, initial=True):
+		self.deadbands = dict(DEADBANDS)
+		if deadbands:
+			self.deadbands.update(deadbands)
+		self.initial = initial
+		self.reported = {}
+		self.failing = set()
+
+	def below(self, name, change, deadband):
+		"""True if *change* is smaller than *deadband*, compared in raw register units (19.2 to 19.3 is one step of 0.1)."""
+		reg = love8c.REGISTERS.get(name)
+		scale = 10 ** reg.decimals if reg is not None else 1
+		return int(round(change * scale)) < int(round(deadband * scale))
+
+	def event(self, portname, address, timestamp, kind, name, value, previous):
+		event = {"time": timestamp, "port": portname, "address": address, "event": kind, "name": name, "value": value, "previous": previous}
+		if name in love8c.REGISTER_ENUMS:
+			texts = love8c.REGISTER_ENUMS[name]
+			event["text"] = texts.get(value)
+			event["previous_text"] = texts.get(previous)
+		return event
+
+	def changes(self, portname, address, data, timestamp):
+		"""Events of one read, data is a dict name -> value or a :func:`love8c.error_data` dict."""
+		key = (portname, address)
+		if "error" in data:
+			if key in self.failing:
+				return []
+			self.failing.add(key)
+			return [{"time": timestamp, "port": portname, "address": address, "event": "error", "error": data}]
+		self.failing.discard(key)
+		reported = self.reported.setdefault(key, {})
+		events = []
+		for name, value in data.items():
+			if name not in reported:
+				reported[name] = value
+				if self.initial:
+					events.append(self.event(portname, address, timestamp, "initial", name, value, None))
+				continue
+			previous = reported[name]
+			if name == 'leds':
+				if value == previous:
+					continue
+				reported[name] = value
+				lit = love8c.decode_leds(value)
+				was_lit = love8c.decode_leds(previous)
+				for led, bit in love8c.LEDS_BITS:
+					if lit[led] != was_lit[led]:
+						event = self.event(portname, address, timestamp, "led", name, lit[led], was_lit[led])
+						event["led"] = led
+						events.append(event)
+				continue
+			deadband = self.deadbands.get(name, 0)
+			if value == previous or (deadband and self.below(name, abs(value - previous), deadband)):
+				continue
+			reported[name] = value
+			events.append(self.event(portname, address, timestamp, "change", name, value, previous))
+		return events
+
+
+def watch(buses, callback, names=None, deadbands=None, rates=None, instrument_factory=None, stop_event=None, initial=True):
+	"""Poll *buses* (port name -> addresses) and call callback(event) for every change until *stop_event* is set."""
+	import love8c_bus
+	if names is None:
+		names = WATCH_NAMES
+	detector = ChangeDetector(deadbands, initial)
+	def on_data(portname, address, data, timestamp):
+		for event in detector.changes(portname, address, data, timestamp):
+			callback(event)
+	love8c_bus.Fleet(buses, instrument_factory).poll(on_data, names, rates, stop_event)
+
+def events(buses, names=None, deadbands=None, rates=None, instrument_factory=None, initial=True):
+	"""Generator of the change events of :func:`watch`, polling stops when the generator is closed."""
+	results = queue.Queue()
+	stop_event = threading.Event()
+	def run():
+		try:
+			watch(buses, results.put, names, deadbands, rates, instrument_factory, stop_event, initial)
+		finally:
+			results.put(None)
+	thread = threading.Thread(target=run)
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			event = results.get()
+			if event is None:
+				break
+			yield event
+	finally:
+		stop_event.set()